@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+# Benchmarks of the post-processing and analysis pipeline, without a radio. Each stage runs on synthetic FID,
+# spin echo and CPMG traces shaped like the ones the radio returns (raw samples at -TUNE_SHIFT, 1 MS/s), at sizes
+# from a onepulse buffer up to tens of millions of samples, or on the shots of a recording.
+# For every stage this reports the latency of one call (best of several), the throughput in samples/s and the
+# peak memory allocated during a call, and checks its numerical output against the known parameters of the
+# synthetic trace. With a baseline, latencies are compared against it and the outputs have to match it closely.
+#
+#   python benchmarks/bench.py                        run and compare against benchmarks/baseline.json
+#   python benchmarks/bench.py --save                 store the results as the new baseline
+#   python benchmarks/bench.py --sizes 1e4 3e7        other trace sizes
+#   python benchmarks/bench.py --recording session1   also time the raw shots of a recording
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from sdmrr.analysis import (Decimator, combine_echoes, demodulate, echo_windows, fit_bi, fit_mono, get_t2,
+                            lowpass, t2_distribution, Recording)
+from sdmrr.dsp import peak_frequency
+from sdmrr.receive import EchoGate
+from sdmrr.echoes import echo_starts
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+FS = 1e6
+SHIFT = 50000       # SDMRR.TUNE_SHIFT
+CUTOFF = 20000      # lowpass used by pulseecho and ncpmg
+PHASE = 0.7         # phase of the signal after demodulation (rad)
+OFFSET = 750.0      # Larmor offset of the FID and spin echo (Hz), a whole FFT bin of 4000 samples
+AMPLITUDE = 0.05
+NOISE = 2e-3
+T2STAR = 150e-6     # echo and FID width
+TR = 500e-6         # CPMG echo spacing
+T90 = 30e-6
+WIDTH = 200         # echo window
+CHUNK = 65536       # samples per chunk for the streaming stages
+SIZES = [1e4, 1e5, 1e6, 1e7]
+
+############################## Synthetic Traces ##########################
+def _raw(baseband, rng):
+    #What the radio hands over: the baseband signal at -SHIFT, plus noise, in complex64
+    n = len(baseband)
+    noise = NOISE * rng.standard_normal(2*n).astype(np.float32).view(np.complex64)
+    return (baseband * np.exp(-2j*np.pi*SHIFT*np.arange(n)/FS)).astype(np.complex64) + noise
+
+def fid_trace(n, rng):
+    t = np.arange(n) / FS
+    return _raw(AMPLITUDE * np.exp(-t/(10*T2STAR) + 1j*(2*np.pi*OFFSET*t + PHASE)), rng)
+
+def echo_trace(n, rng):
+    #Spin echo in the middle of the trace
+    t = np.arange(n) / FS
+    centre = t[n // 2]
+    return _raw(AMPLITUDE * np.exp(-np.abs(t - centre)/T2STAR + 1j*(2*np.pi*OFFSET*(t - centre) + PHASE)), rng)
+
+def cpmg_trace(n, rng):
+    #On resonance CPMG train decaying over a third of the trace, with echo k centred like echo_starts expects.
+    #Returns the trace, the number of echoes and T2.
+    npulses = int((n/FS - T90) / TR) - 1
+    t2 = n / FS / 3
+    k = np.clip(np.rint((np.arange(n) - T90*FS) / (TR*FS)), 1, max(npulses, 1))
+    centre = k * TR * FS + T90 * FS
+    envelope = AMPLITUDE * np.exp(-k*TR/t2 - np.abs(np.arange(n) - centre)/(T2STAR*FS))
+    return _raw(envelope * np.exp(1j*PHASE), rng), npulses, t2
+
+def decays(ndecays, nechoes, rng, t2s = None):
+    #Batch of echo amplitude decays with T2 spread over a decade
+    t2s = np.geomspace(20*TR, 200*TR, ndecays) if t2s is None else t2s
+    t = np.arange(nechoes) * TR
+    y = np.exp(-t[None, :] / t2s[:, None]) + 0.01 * rng.standard_normal((ndecays, nechoes))
+    return y, t2s
+
+############################## Stages ##########################
+def _stream(stage, trace):
+    for i in range(0, len(trace), CHUNK):
+        stage(i, trace[None, i:i+CHUNK])
+    return stage
+
+def trace_stages(n, rng):
+    #(name, samples, run, values, truth) for the stages that process one trace of n samples. run() returns the
+    #output, values(output) the numbers that are checked, and truth maps each of them to (expected, tolerance).
+    fid = fid_trace(n, rng)
+    cpmg, npulses, t2 = cpmg_trace(n, rng)
+    base = demodulate(cpmg, SHIFT, FS)
+    filtered, _ = lowpass(base, 3, CUTOFF, FS)
+    stages = [
+        ("demodulate", n, lambda: demodulate(fid, SHIFT, FS),
+         lambda z: {"phase": float(np.angle(np.sum(z[:200] * np.exp(-2j*np.pi*OFFSET*np.arange(200)/FS))))},
+         {"phase": (PHASE, 0.05)}),
+        ("lowpass", n, lambda: lowpass(base, 3, CUTOFF, FS)[0],
+         lambda z: {"rms": float(np.sqrt(np.mean(np.abs(z)**2)))}, {}),
+        ("decimate", n, lambda: _stream(Decimator(n, FS, 50e3, SHIFT, cutoff=CUTOFF), cpmg).out,
+         lambda z: {"rms": float(np.sqrt(np.mean(np.abs(z)**2)))}, {}),
+    ]
+    if npulses >= 4:
+        def _amps(windows):
+            mags, _, _ = combine_echoes(windows)
+            return mags
+
+        def _echo_values(mags):
+            #T2 of the echo train and the first echo amplitude, as get_t2 sees them
+            return {"echo0": float(mags[0]), "t2": float(get_t2(mags, TR))}
+
+        first_echo = AMPLITUDE * np.exp(-TR/t2)
+        truth = {"echo0": (first_echo, 0.1*first_echo), "t2": (t2, 0.05*t2)}
+        starts = echo_starts(npulses, TR, T90, FS, WIDTH)
+        stages += [
+            ("echo_windows", n, lambda: _amps(echo_windows(filtered, TR, T90, FS, npulses, WIDTH)), _echo_values, truth),
+            ("echo_gate", n, lambda: _amps(_stream(EchoGate(starts, WIDTH, FS, SHIFT, 3, CUTOFF), cpmg).windows),
+             _echo_values, truth),
+            ("get_t2", npulses, lambda: get_t2(_amps(echo_windows(filtered, TR, T90, FS, npulses, WIDTH)), TR),
+             lambda t: {"t2": float(t)}, {"t2": (t2, 0.05*t2)}),
+        ]
+    return stages
+
+def fixed_stages(rng):
+    #Stages that always see the same amount of data: the peak pick of find_f0 on 4000 samples around the echo,
+    #and fits of batches of decays
+    echo = echo_trace(4000, rng)
+    y, t2s = decays(2000, 200, rng)
+    y2, _ = decays(200, 200, rng)
+    y2 += np.exp(-np.arange(200)*TR / (5*TR))
+    one, _ = decays(1, 200, rng, np.array([50*TR]))
+
+    def _t2_peak(result):
+        t2_grid, amps, residual = result
+        return {"t2_peak": float(np.median(t2_grid[np.argmax(amps, axis=1)]))}
+
+    return [
+        ("peak_frequency", len(echo), lambda: peak_frequency(demodulate(echo, SHIFT, FS), FS),
+         lambda f: {"offset": float(f)}, {"offset": (OFFSET, FS/len(echo))}),
+        ("fit_mono", y.size, lambda: fit_mono(y, TR)[0],
+         lambda p: {"t2_err": float(np.median(np.abs(p[:, 1]/t2s - 1)))}, {"t2_err": (0, 0.05)}),
+        ("fit_bi", y2.size, lambda: fit_bi(y2, TR)[0],
+         lambda p: {"t2a": float(np.median(p[:, 1]))}, {"t2a": (5*TR, 0.5*TR)}),
+        ("t2_distribution", one.size, lambda: t2_distribution(one, TR), _t2_peak, {"t2_peak": (50*TR, 10*TR)}),
+    ]
+
+def recording_stages(path):
+    #Post processing of the full-rate raw shots of a recording, as the sequences do it
+    rec = Recording(path)
+    stages = []
+    for i, entry in enumerate(rec.records):
+        params = entry["params"]
+        if entry["name"] not in ("onepulse", "pulseecho", "ncpmg") or len(entry["shape"]) != 1 or params.get("rate"):
+            continue
+        raw = np.array(rec[i])
+
+        def _process(raw = raw, params = params, name = entry["name"]):
+            z, _ = lowpass(demodulate(raw, SHIFT, FS), 3, CUTOFF, FS)
+            if name != "ncpmg":
+                return z
+            return combine_echoes(echo_windows(z, params["tr"], params["t90"], FS, params["npulses"], WIDTH))[0]
+
+        stages.append(("recording%d_%s" % (i, entry["name"]), len(raw), _process,
+                       lambda out: {"peak": float(np.max(np.abs(out)))}, {}))
+    return stages
+
+############################## Measurement ##########################
+def measure(run, min_time = 0.2, max_repeats = 20):
+    #Best latency of repeated calls, then the peak memory of one more call
+    run()   # warm up caches (filters, phasor tables, kernels)
+    times = []
+    start = time.perf_counter()
+    while len(times) < max_repeats and (len(times) < 3 or time.perf_counter() - start < min_time):
+        t = time.perf_counter()
+        output = run()
+        times.append(time.perf_counter() - t)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return output, min(times), peak
+
+def compare(key, result, baseline, tolerance, rtol):
+    #Problems with one result, against the truth and the baseline
+    problems = []
+    for name, (expected, tol) in result["truth"].items():
+        if abs(result["values"][name] - expected) > tol:
+            problems.append("%s %.6g, expected %.6g +/- %.2g" % (name, result["values"][name], expected, tol))
+    old = baseline.get(key)
+    if old is not None:
+        if result["latency"] > tolerance * old["latency"]:
+            problems.append("%.1fx slower than the baseline" % (result["latency"] / old["latency"]))
+        for name, value in result["values"].items():
+            if name in old["values"] and not np.isclose(value, old["values"][name], rtol=rtol, atol=rtol*1e-3):
+                problems.append("%s %.6g, baseline %.6g" % (name, value, old["values"][name]))
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sdmrr post-processing pipeline without a radio")
+    parser.add_argument("--sizes", type=float, nargs="*", default=SIZES, help="trace sizes in samples")
+    parser.add_argument("--recording", help="also benchmark the raw shots of this recording")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="allowed slowdown against the baseline")
+    parser.add_argument("--rtol", type=float, default=1e-3, help="allowed relative change of the outputs against the baseline")
+    parser.add_argument("--stage", nargs="+", help="only run these stages")
+    options = parser.parse_args()
+
+    baseline = {}
+    if os.path.isfile(options.baseline) and not options.save:
+        with open(options.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    #The traces of one size are only made when their stages run, so the largest sizes are not all in memory at once
+    rng = np.random.default_rng(0)
+    groups = [lambda: fixed_stages(rng)] + [lambda n=int(n): trace_stages(n, rng) for n in options.sizes]
+    if options.recording is not None:
+        groups.append(lambda: recording_stages(options.recording))
+
+    results = {}
+    failed = 0
+    print("%-28s %12s %12s %14s %10s" % ("stage", "samples", "latency ms", "samples/s", "peak MB"))
+    for name, size, run, values, truth in (stage for group in groups for stage in group()):
+        if options.stage is not None and name not in options.stage:
+            continue
+        key = "%s/%d" % (name, size)
+        output, latency, peak = measure(run)
+        result = {"samples": size, "latency": latency, "throughput": size / latency, "peak_mb": peak / 2**20,
+                  "values": values(output), "truth": truth}
+        results[key] = result
+        problems = compare(key, result, baseline, options.tolerance, options.rtol)
+        failed += bool(problems)
+        print("%-28s %12d %12.3f %14.4g %10.1f  %s" % (name, size, 1e3*latency, result["throughput"], result["peak_mb"],
+                                                   "; ".join(problems) if problems else "ok"))
+
+    if options.save:
+        machine = {"platform": platform.platform(), "python": platform.python_version(), "numpy": np.__version__,
+                   "processor": platform.processor(), "date": time.strftime("%Y-%m-%d")}
+        for result in results.values():
+            del result["truth"]
+        with open(options.baseline, "w") as f:
+            json.dump({"machine": machine, "results": results}, f, indent=1)
+        print("Saved %d results to %s" % (len(results), options.baseline))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
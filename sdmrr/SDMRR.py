@@ -1,11 +1,23 @@
 import numpy as np
-import uhd
-from uhd import libpyuhd as lib
-from threading import Thread
+from threading import Event, Thread, current_thread, main_thread
 import time
-import scipy.signal as sg
-import scipy.optimize as opt
 import json
+import inspect
+from queue import Queue
+from sdmrr.receive import BufferPool, Decimator, EchoGate, receive
+from sdmrr.session import RadioSession
+from sdmrr.waveforms import pulse_waveform
+from sdmrr.sequence import echo_train, look_locker_train
+from sdmrr.dsp import demodulate, lowpass, peak_frequency
+from sdmrr.echoes import combine_echoes, echo_starts, echo_windows
+from sdmrr.scheduler import ShotScheduler
+from sdmrr.nutation import SWEEP_DROP, SWEEP_RATIO, fit_nutation, next_nutation_point, nutation_model
+from sdmrr.tracking import FrequencyTracker, frequency_offset
+from sdmrr.averaging import RunningAverage, fit_t2_error
+from sdmrr.analysis import get_t2
+from sdmrr.fitting import fit_look_locker
+from sdmrr.recorder import Recorder
+from sdmrr.metrics import NULL_SHOT
 
 #For suppressing printing
 import sys
@@ -22,15 +34,32 @@ class SDMRR:
     TUNE_SHIFT = 50000
     RX_SHIFT = 0
     ZBUFF_TIME = 40e-6
+    GATE_CHUNK = 65536
     
-    RX_DATA = np.empty(NS, dtype=np.complex64)
-    
-    def __init__(self, nocal = False):
-        with HiddenPrints():
-            self.radio = uhd.usrp.MultiUSRP("type=b200")
-        self.radio.set_gpio_attr('FP0', 'CTRL', 0x000, 0xFFF) #pin 1 on ATR
-        self.radio.set_gpio_attr('FP0', 'DDR', 0xFFF, 0xFFF) # all outputs
-        self.radio.set_gpio_attr("FP0", "OUT", 0x002, 0xFFF); #pin 2 ON
+    def __init__(self, nocal = False, backend = None, args = "type=b200", cal_path = "cal.json"):
+        #The backend provides the uhd API. Pass a sdmrr.SimulatedUHD to run without a radio.
+        #args selects the device, and cal_path is where this device's calibration is kept.
+        #The radio is opened (and an out of date calibration redone) in a background thread, so this returns right
+        #away. Acquisitions wait for it when they need the radio, see ready().
+        self.uhd = backend
+        self.lib = None if backend is None else backend.libpyuhd
+        self.args = args
+        self.cal_path = cal_path
+        self.radio = None
+        self.session = None #Streamers and the current tuning are kept between shots
+
+        #Receive buffers are per instance and reused between shots
+        self.RX_DATA = np.empty(self.NS, dtype=np.complex64)
+        self.buffers = BufferPool()
+
+        self.last_shot_end = None #time.monotonic() at the end of the last shot
+        self.recorder = None #Every shot is written to this Recorder while it is set, see record()
+        self.metrics = None #Set to a sdmrr.Metrics to time every shot and count stream errors
+
+        #Follows f0 between calibrations using the acquired data. Set to None to disable.
+        self.tracker = FrequencyTracker()
+        self._recal = False #the tracker lost f0 or it drifted too far, calibrate before the next acquisition
+        self._calibrating = False
         
         #Defaults
         self.caldict = {
@@ -38,21 +67,69 @@ class SDMRR:
             "t90": 0.0003
             }
         
-        if(os.path.isfile('cal.json')):
+        if(os.path.isfile(self.cal_path)):
             print("Loading Calibration Data")
-            with open('cal.json', 'r') as cal:
+            with open(self.cal_path, 'r') as cal:
                 self.caldict = json.load(cal)
 
             print("Last Calibration: " + (time.asctime(time.localtime(self.caldict["lastcal"]))))
-            if not nocal:
+            self.tracker.reset(self.caldict["f0"])
+        else:
+            nocal = True #nothing to check until the first cal()
+
+        self._startup_error = None
+        self.cal_error = None #why the startup calibration failed, if it did
+        self._startup = Thread(target=self._start, args=(nocal,), daemon=True)
+        self._startup.start()
+
+    def ready(self, timeout = None):
+        #Wait until the radio is open and the startup calibration (if any) is done. Returns False on timeout, and
+        #raises the error if opening the radio failed.
+        if current_thread() is self._startup:
+            return True
+        self._startup.join(timeout)
+        if self._startup_error is not None:
+            raise self._startup_error
+        if self._startup.is_alive():
+            return False
+        if self._recal and not self._calibrating:
+            self._recal = False
+            self.cal()
+        return True
+
+    def _start(self, nocal):
+        try:
+            if self.uhd is None:
+                import uhd
+                self.uhd = uhd
+                self.lib = uhd.libpyuhd
+
+            radio = self.uhd.usrp.MultiUSRP(self.args)
+            radio.set_gpio_attr('FP0', 'CTRL', 0x000, 0xFFF) #pin 1 on ATR
+            radio.set_gpio_attr('FP0', 'DDR', 0xFFF, 0xFFF) # all outputs
+            radio.set_gpio_attr("FP0", "OUT", 0x002, 0xFFF); #pin 2 ON
+            self.session = RadioSession(radio, self.uhd)
+            self.radio = radio
+        except Exception as e:
+            self._startup_error = e
+            return
+
+        if not nocal:
+            try:
                 self.check_cal()
+            except Exception as e:
+                #The radio is open, so the console stays usable with the old calibration
+                print("Startup calibration failed: %r" % (e,))
+                self.cal_error = e
 
     def onepulse(self, freq = None, t90 = None, gain = 50, filt = True, start_time = 0.2, amp = 1):
+        self.ready()
 
         if freq is None:
             freq = self.caldict["f0"]
         if t90 is None:
             t90 = self.caldict["t90"]
+        shot = self._shot("onepulse")
 
         #Sequencing variables
         tx_start_time = start_time - self.ZBUFF_TIME
@@ -60,110 +137,85 @@ class SDMRR:
         sw_off_time = start_time + self.DEAD_TIME + t90 
         rx_start_time = start_time - 100e-6
 
-        #Set up the streamer before we start receiving, as this setup causes the radio to stop RX
-        tx_st_args = lib.usrp.stream_args("fc32", "sc16")
-        tx_st_args.channels = [0]
-        global tx_streamer
-        try: tx_streamer
-        except NameError:
-            tx_streamer = self.radio.get_tx_stream(tx_st_args)
-        else:
-            if tx_streamer is None:
-                tx_streamer = self.radio.get_tx_stream(tx_st_args)
+        #Set up the streamers before we start receiving, as this setup causes the radio to stop RX
+        tx_streamer = self.session.tx_streamer()
+        rx_streamer = self.session.rx_streamer()
 
         #Set up TX stream metadata (includes timing)
-        tx_metadata = lib.types.tx_metadata()
-        tx_metadata.time_spec = lib.types.time_spec(tx_start_time)
+        tx_metadata = self.lib.types.tx_metadata()
+        tx_metadata.time_spec = self.lib.types.time_spec(tx_start_time)
         tx_metadata.start_of_burst = True
         tx_metadata.end_of_burst = True
         tx_metadata.has_time_spec = True
+        shot.mark("setup")
 
-        self.radio.set_tx_rate(self.FS, 0)
-        self.radio.set_tx_freq(lib.types.tune_request(freq + 120e6 + self.TUNE_SHIFT), 0)
-        self.radio.set_tx_gain(gain, 0)
+        #Set up TX and RX, only changed settings are sent to the radio
+        self.session.tune(self.FS, freq + 120e6 + self.TUNE_SHIFT, gain, freq + 120e6 + self.TUNE_SHIFT, self.RX_GAIN)
+        shot.mark("tune")
 
-        # Set up the stream and receive buffer
-        rx_st_args = uhd.usrp.StreamArgs("fc32", "sc16")
-        rx_st_args.channels = [1]
-
-        global rx_streamer
-        try: rx_streamer
-        except NameError:
-            rx_streamer = self.radio.get_rx_stream(rx_st_args)
-        else:
-            if rx_streamer is None:
-                rx_streamer = self.radio.get_rx_stream(rx_st_args)
-                
-        #Set up RX
-        self.radio.set_rx_rate(self.FS, 1)
-        self.radio.set_rx_freq(uhd.libpyuhd.types.tune_request(freq + 120e6 + self.TUNE_SHIFT), 1)
-        self.radio.set_rx_gain(self.RX_GAIN, 1)
-
-        recv_buffer = np.zeros((1,1000), dtype=np.complex64)
-        rx_metadata = uhd.types.RXMetadata()
+        rx_metadata = self.uhd.types.RXMetadata()
 
         # Setup stream command
-        stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.num_done)
+        stream_cmd = self.uhd.types.StreamCMD(self.uhd.types.StreamMode.num_done)
         stream_cmd.num_samps = self.NS
         stream_cmd.stream_now = False
-        stream_cmd.time_spec = lib.types.time_spec(rx_start_time)
+        stream_cmd.time_spec = self.lib.types.time_spec(rx_start_time)
 
         #Create the pulse
-        t = np.arange(0, t90, 1/self.FS)
-        waveform_proto = amp*np.complex64(np.concatenate((np.zeros(int(self.ZBUFF_TIME * self.FS)), np.exp(-self.TUNE_SHIFT*np.pi*2j*t))))
+        waveform_proto = pulse_waveform(t90, amp, 0, self.FS, self.TUNE_SHIFT, self.ZBUFF_TIME)
+        shot.mark("waveform")
 
-        self.radio.set_time_now(lib.types.time_spec(0.0))
+        self.radio.set_time_now(self.lib.types.time_spec(0.0))
 
         #Send the tx command
         with HiddenPrints():
             samples = tx_streamer.send(waveform_proto, tx_metadata)
+        shot.tx(samples, len(waveform_proto))
+        shot.mark("tx_send")
 
         self.radio.clear_command_time();
-        self.radio.set_command_time(lib.types.time_spec(sw_on_time));
+        self.radio.set_command_time(self.lib.types.time_spec(sw_on_time));
         self.radio.set_gpio_attr("FP0", "OUT", 0x000, 0xFFF); #pin 2 OFF
         self.radio.clear_command_time();
 
         self.radio.clear_command_time();
-        self.radio.set_command_time(lib.types.time_spec(sw_off_time));
+        self.radio.set_command_time(self.lib.types.time_spec(sw_off_time));
         self.radio.set_gpio_attr('FP0', 'OUT', 0x002, 0xFFF) #pin 2 ON
         self.radio.clear_command_time();
+        shot.mark("gpio")
 
 
         rx_streamer.issue_stream_cmd(stream_cmd)
-
-        #Receive Samples.  recv() will return zeros, then our samples, then more zeros, letting us know it's done
-        waiting_to_start = True # keep track of where we are in the cycle (see above comment)
-        nsamps = 0
-        i = 0
-        while nsamps != 0 or waiting_to_start:
-            nsamps = rx_streamer.recv(recv_buffer, rx_metadata)
-            if nsamps and waiting_to_start:
-                waiting_to_start = False
-            if nsamps:
-                self.RX_DATA[i:i+nsamps] = recv_buffer[0,0:nsamps]
-            i += nsamps
-
-
-        # tx_streamer = None
-        # rx_streamer = None
+        shot.expect(rx_start_time, self.NS)
+
+        #Receive Samples straight into the data buffer, and to disk if recording
+        record = self._begin_record("onepulse", self.NS, freq=freq, t90=t90, gain=gain, start_time=start_time, amp=amp)
+        if receive(rx_streamer, self.RX_DATA, rx_metadata, on_chunk=record, stats=shot) < self.NS:
+            self.session.reset() #start from fresh streamers if the stream did not finish
+        self.last_shot_end = time.monotonic()
+        if record is not None:
+            record.end()
+        shot.mark("rx")
+        shot.tx_async(tx_streamer, self.uhd.types.TXAsyncMetadata())
+        shot.mark("tx_async")
 
         #Process the data
-        t = np.arange(self.NS)/self.FS
-        exp = np.exp(self.TUNE_SHIFT*np.pi*2*1j*t)
-        data = self.RX_DATA*exp
+        data = demodulate(self.RX_DATA, self.TUNE_SHIFT, self.FS)
         
         eshift = -np.angle(np.average(data[350:500]))   #phase properly
-        data = data*np.exp(1j*eshift)
+        data *= np.complex64(np.exp(1j*eshift))
 
         if filt:
-            b, a = sg.butter(3, 0.004)
-            zi = sg.lfilter_zi(b, a)
-            z, _ = sg.lfilter(b, a, data, zi=zi*data[0])
-            return z
-        else:
-            return data
+            lowpass(data, 3, 0.002*self.FS, self.FS, out=data) #0.004 of nyquist
+
+        fidstart_idx = int((self.DEAD_TIME + t90 + 100e-6)*self.FS) + 500 #extra 500 for lowpass filter
+        self._track(freq, data[fidstart_idx:fidstart_idx+3000])
+        shot.mark("process")
+        shot.finish()
+        return data
         
-    def pulseecho(self, f0 = None, t90 = None, gain=70, tr=3e-3, p90p = 0, amp90 = 1, amp180 = None):
+    def pulseecho(self, f0 = None, t90 = None, gain=70, tr=3e-3, p90p = 0, amp90 = 1, amp180 = None, rate = None):
+        self.ready()
         if f0 is None:
             f0 = self.caldict["f0"]
         if t90 is None:
@@ -173,351 +225,417 @@ class SDMRR:
         if amp180 is None:
             t180 = 2*t90
             amp180 = 1
+        shot = self._shot("pulseecho")
+
+        #Both pulses go out in one burst with the T/R switch around each of them, compiled once and cached
+        sequence = echo_train(0.1, t90, amp90, p90p, t180, amp180, (1,), tr, self.FS, self.TUNE_SHIFT, self.ZBUFF_TIME, self.DEAD_TIME)
+        exp_len = sequence.rx[1] #the number of samples for the full experiment
+        shot.mark("waveform")
+
+        params = dict(f0=f0, t90=t90, gain=gain, tr=tr, p90p=p90p, amp90=amp90, amp180=amp180)
+        if rate is not None:
+            #Demodulate, filter and decimate the trace as it arrives, only the decimated samples are kept
+            dec = Decimator(exp_len, self.FS, rate, self.TUNE_SHIFT, cutoff=min(20000, 0.4*rate))
+            bigbuff = self.buffers.get(min(exp_len, self.GATE_CHUNK), "rx_ring")
+            record = dec.on_chunk = self._begin_record("pulseecho", dec.nsamps, rate=dec.rate, delay=dec.delay, **params)
+        else:
+            dec = None
+            bigbuff = self.buffers.get(exp_len)
+            record = self._begin_record("pulseecho", exp_len, **params)
 
-        self.radio.set_gpio_attr('FP0', 'OUT', 0x002, 0xFFF) #pin 2 ON
-
-        ############################## Internal Helpers ##########################
-        def _pulse(start_time, firstpulse, phase):
-
-            #Sequencing variables
-            tx_start_time = start_time - self.ZBUFF_TIME
-            sw_on_time = start_time - 5e-6
-            sw_off_time = start_time + self.DEAD_TIME + (t90 if firstpulse else t180)
-            tx_metadata.time_spec = lib.types.time_spec(tx_start_time)
-
-            #Send the tx command
-            with HiddenPrints():
-                samples = tx_streamer.send((t90_proto if firstpulse else t180_protos[phase]), tx_metadata)
-
-            self.radio.clear_command_time();
-            self.radio.set_command_time(lib.types.time_spec(sw_on_time));
-            self.radio.set_gpio_attr("FP0", "OUT", 0x003, 0xFFF); #pin 1 ON (keep pin 2 on)
-            self.radio.clear_command_time();
-
-            self.radio.clear_command_time();
-            self.radio.set_command_time(lib.types.time_spec(sw_off_time));
-            self.radio.set_gpio_attr('FP0', 'OUT', 0x002, 0xFFF) #pin 1 OFF
-            self.radio.clear_command_time();
-
-        def _rx():
-            recv_buffer = np.zeros((1,500000), dtype=np.complex64)
-            #Receive Samples.  recv() will return zeros, then our samples, then more zeros, letting us know it's done
-            waiting_to_start = True # keep track of where we are in the cycle (see above comment)
-            nsamps = 0
-            i = 0
-            while nsamps != 0 or waiting_to_start:
-                nsamps = rx_streamer.recv(recv_buffer, uhd.types.RXMetadata())
-                if nsamps and waiting_to_start:
-                    waiting_to_start = False
-                    i = 0
-                if nsamps:
-                    # print(nsamps)
-                    # for j in range(49):
-                    #     start = int((j+1) * 10000 - 100)
-                    #     bigbuff[0,j*200:(j+1)*200] = recv_buffer[0,start:start+200]
-                    bigbuff[0, i:i+nsamps] = recv_buffer[0,0:nsamps]
-                i += nsamps
-
-
-        exp_len = int((2 * tr + t90)*self.FS) #the number of samples for the full experiment
-        #global bigbuff
-        bigbuff = np.zeros((1, exp_len), dtype=np.complex64)
-
-        #Set up the streamer before we start receiving, as this setup causes the radio to stop RX
-        tx_st_args = lib.usrp.stream_args("fc32", "sc16")
-        tx_st_args.channels = [0]
-        tx_streamer = self.radio.get_tx_stream(tx_st_args)
-
-        #Set up TX stream metadata (includes timing)
-        tx_metadata = lib.types.tx_metadata()
-        tx_metadata.start_of_burst = True
-        tx_metadata.end_of_burst = True
-        tx_metadata.has_time_spec = True
-
-        self.radio.set_tx_rate(self.FS, 0)
-        self.radio.set_tx_freq(lib.types.tune_request(f0 + 120e6 + self.TUNE_SHIFT), 0)
-        self.radio.set_tx_gain(gain, 0)
-
-        #Set up RX
-        self.radio.set_rx_rate(self.FS, 1)
-        self.radio.set_rx_freq(uhd.libpyuhd.types.tune_request(f0 + 120e6 + self.TUNE_SHIFT), 1)
-        self.radio.set_rx_gain(self.RX_GAIN, 1)
-
-        # Set up the stream and receive buffer
-        rx_st_args = uhd.usrp.StreamArgs("fc32", "sc16")
-        rx_st_args.channels = [1]
-        #global rx_streamer
-        rx_streamer = self.radio.get_rx_stream(rx_st_args)
-
-        # Setup stream command
-        stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.num_done)
-        stream_cmd.num_samps = exp_len
-        stream_cmd.stream_now = False
-
-        #Create the pulses    
-        zero_buff = np.zeros(int(self.ZBUFF_TIME * self.FS))
-        t90_base = amp90*np.exp(-self.TUNE_SHIFT*np.pi*2j*np.arange(0, t90, 1/self.FS))
-        t180_base = amp180*np.exp(-self.TUNE_SHIFT*np.pi*2j*np.arange(0, t180, 1/self.FS))
-
-        t90_proto = np.complex64(np.concatenate((zero_buff, t90_base*1j**p90p)))
-        t180_protos = ([np.complex64(np.concatenate((zero_buff, t180_base*1j**i))) for i in range(4)])
-
-        #Reset time to 0
-        self.radio.set_time_now(lib.types.time_spec(0.0))
-        stream_cmd.time_spec = lib.types.time_spec(0.1)
-        rx_thread = Thread(target=_rx, args=())
-
-        #Reset time to 0
-        self.radio.set_time_now(lib.types.time_spec(0.0))   
-
-        rx_streamer.issue_stream_cmd(stream_cmd)
-        rx_thread.start() 
-
-        _pulse(0.1, firstpulse=True, phase=0)
-        _pulse(0.1 + tr/2, firstpulse=False, phase=1)
-
-        rx_thread.join()
-
-        tx_streamer = None
-        rx_streamer = None
+        #Receive straight into the experiment buffer (through the decimator if given), and to disk if recording
+        self._run_shot(shot, sequence, f0, gain, bigbuff, on_chunk=dec or record)
+        if record is not None:
+            record.end()
 
 
         ########################## Post Processing ##########################
-        b, a = sg.butter(3, 20000, fs=self.FS)
-        zi = sg.lfilter_zi(b, a)
+        echo_idx = int((tr + t90)*self.FS)
+        if dec is not None:
+            data = dec.out
+            eshift = -np.angle(np.average(data[dec.index(177):dec.index(197) + 1]))
+            data *= np.complex64(np.exp(1j*eshift))
+            self._track(f0, data[dec.index(max(0, echo_idx-400)):dec.index(echo_idx+400)])
+            shot.mark("process")
+            shot.finish()
+            return data
 
-        t = np.arange(len(bigbuff[0]))/self.FS
-        exp = np.exp(self.TUNE_SHIFT*np.pi*2*1j*t)
-        z, _ = sg.lfilter(b, a, bigbuff[0]*exp, zi=zi*bigbuff[0,0])
+        data = demodulate(bigbuff[0], self.TUNE_SHIFT, self.FS)
+
+        #The filter is causal, so only the samples up to the phase reference need filtering
+        z, _ = lowpass(data[:197], 3, 20000, self.FS)
 
         eshift = -np.angle(np.average(z[177:197]))   #phase properly
-        return bigbuff[0]*exp*np.exp(1j*eshift)
+        data *= np.complex64(np.exp(1j*eshift))
+
+        self._track(f0, lowpass(data[max(0, echo_idx-400):echo_idx+400], 3, 20000, self.FS)[0])
+        shot.mark("process")
+        shot.finish()
+        return data
         
-    def ncpmg(self, f0 = None, t90 = None, gain=70, tr=3e-3, npulses = 100, cycle=[0,0,1,3], width=1000, p90p = 0, amp90 = 1, amp180 = None):
+    def ncpmg(self, f0 = None, t90 = None, gain=70, tr=3e-3, npulses = 100, cycle=[0,0,1,3], width=1000, p90p = 0, amp90 = 1, amp180 = None, gated = False, integrate = False, deferred = False, buffer = "rx", rate = None, on_echo = None, stop = None):
+        #With gated=True, on_echo(k, echo) is called from the receiving thread with each phased echo window (its sum
+        #with integrate=True) as soon as it lands, and once stop(k, echo) is true (e.g. an EchoStop) the rest of the
+        #train is cancelled: no more pulses are sent, the stream is stopped and only the echoes so far are returned.
+        self.ready()
         if f0 is None:
             f0 = self.caldict["f0"]
         if t90 is None:
             t90 = self.caldict["t90"]
+        if (on_echo is not None or stop is not None) and not gated:
+            raise ValueError("on_echo and stop need gated=True")
             
         t180 = t90
         if amp180 is None:
             t180 = 2*t90
             amp180 = 1
-            
-        self.radio.set_gpio_attr('FP0', 'OUT', 0x002, 0xFFF) #pin 2 ON
-            
+        shot = self._shot("ncpmg")
 
         ############################## Internal Helpers ##########################
-        def _pulse(start_time, firstpulse, phase):
-
-            #Sequencing variables
-            tx_start_time = start_time - self.ZBUFF_TIME
-            sw_on_time = start_time - 2e-6
-            sw_off_time = start_time + self.DEAD_TIME + (t90 if firstpulse else t180)
-            tx_metadata.time_spec = lib.types.time_spec(tx_start_time)
-
-            #Send the tx command
-            with HiddenPrints():
-                samples = tx_streamer.send((t90_proto if firstpulse else t180_protos[phase]), tx_metadata)
-
-            if firstpulse:
-                self.radio.clear_command_time();
-                self.radio.set_command_time(lib.types.time_spec(sw_on_time));
-                self.radio.set_gpio_attr("FP0", "OUT", 0x000, 0xFFF); #pin 2 OFF
-                self.radio.clear_command_time();
-
-#             self.radio.clear_command_time();
-#             self.radio.set_command_time(lib.types.time_spec(sw_off_time));
-#             self.radio.set_gpio_attr('FP0', 'OUT', 0x002, 0xFFF) #pin 2 ON
-#             self.radio.clear_command_time();
-
-        def _rx():
-            recv_buffer = np.zeros((1,500000), dtype=np.complex64)
-            #Receive Samples.  recv() will return zeros, then our samples, then more zeros, letting us know it's done
-            waiting_to_start = True # keep track of where we are in the cycle (see above comment)
-            nsamps = 0
-            i = 0
-            while nsamps != 0 or waiting_to_start:
-                nsamps = rx_streamer.recv(recv_buffer, uhd.types.RXMetadata())
-                if nsamps and waiting_to_start:
-                    waiting_to_start = False
-                    i = 0
-                if nsamps:
-                    # print(nsamps)
-                    # for j in range(49):
-                    #     start = int((j+1) * 10000 - 100)
-                    #     bigbuff[0,j*200:(j+1)*200] = recv_buffer[0,start:start+200]
-                    bigbuff[0, i:i+nsamps] = recv_buffer[0,0:nsamps]
-                i += nsamps
-
-
-        exp_len = int(((npulses + 1) * tr + t90)*self.FS) #the number of samples for the full experiment
-        #global bigbuff
-        bigbuff = np.zeros((1, exp_len), dtype=np.complex64)
-
-        #Set up the streamer before we start receiving, as this setup causes the radio to stop RX
-        tx_st_args = lib.usrp.stream_args("fc32", "sc16")
-        tx_st_args.channels = [0]
-        tx_streamer = self.radio.get_tx_stream(tx_st_args)
-
-        #Set up TX stream metadata (includes timing)
-        tx_metadata = lib.types.tx_metadata()
-        tx_metadata.start_of_burst = True
-        tx_metadata.end_of_burst = True
-        tx_metadata.has_time_spec = True
-
-        self.radio.set_tx_rate(self.FS, 0)
-        self.radio.set_tx_freq(lib.types.tune_request(f0 + 120e6 + self.TUNE_SHIFT), 0)
-        self.radio.set_tx_gain(gain, 0)
-
-        #Set up RX
-        self.radio.set_rx_rate(self.FS, 1)
-        self.radio.set_rx_freq(uhd.libpyuhd.types.tune_request(f0 + 120e6 + self.TUNE_SHIFT), 1)
-        self.radio.set_rx_gain(self.RX_GAIN, 1)
-
-        # Set up the stream and receive buffer
-        rx_st_args = uhd.usrp.StreamArgs("fc32", "sc16")
-        rx_st_args.channels = [1]
-        #global rx_streamer
-        rx_streamer = self.radio.get_rx_stream(rx_st_args)
-
-        # Setup stream command
-        stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.num_done)
-        stream_cmd.num_samps = exp_len
-        stream_cmd.stream_now = False
-
-        #Create the pulses    
-        zero_buff = np.zeros(int(self.ZBUFF_TIME * self.FS))
-        t90_base = amp90*np.exp(-self.TUNE_SHIFT*np.pi*2j*np.arange(0, t90, 1/self.FS))
-        t180_base = amp180*np.exp(-self.TUNE_SHIFT*np.pi*2j*np.arange(0, t180, 1/self.FS))
-
-        t90_proto = np.complex64(np.concatenate((zero_buff, t90_base*1j**p90p)))
-        t180_protos = ([np.complex64(np.concatenate((zero_buff, t180_base*1j**i))) for i in range(4)])
-
-        #Reset time to 0
-        self.radio.set_time_now(lib.types.time_spec(0.0))
-        stream_cmd.time_spec = lib.types.time_spec(0.1)
-        rx_thread = Thread(target=_rx, args=())
-
-        #Reset time to 0
-        self.radio.set_time_now(lib.types.time_spec(0.0))   
-
-        rx_streamer.issue_stream_cmd(stream_cmd)
-        rx_thread.start() 
-
-        _pulse(0.1, firstpulse=True, phase=0)
-        for i in range(npulses):
-            _pulse(0.1 + tr*i + tr/2, firstpulse=False, phase=cycle[i%4])
-            #cpmg_data[i] = self.RX_DATA
-
-        rx_thread.join()
-        self.radio.set_gpio_attr('FP0', 'OUT', 0x002, 0xFFF) #pin 2 ON
+        def _on_window(k):
+            #Hand the echo over as it lands, and cancel the rest of the train when asked to
+            if phase[0] is None:
+                phase[0] = np.complex64(np.exp(-1j*np.angle(np.average(gate.head[60:80]))))
+            echo = (gate.sums[k] if integrate else gate.windows[k]) * phase[0]
+            if on_echo is not None:
+                on_echo(k, echo)
+            if stop is not None and not cancel.is_set() and stop(k, echo):
+                cancel.set()
+                shot.cancel()
+
+
+        #The whole echo train is one burst, with pin 2 switched off before the 90 degree pulse. Compiled once and cached.
+        phases = tuple(cycle[i%4] for i in range(npulses))
+        sequence = echo_train(0.1, t90, amp90, p90p, t180, amp180, phases, tr, self.FS, self.TUNE_SHIFT, self.ZBUFF_TIME,
+                              self.DEAD_TIME, gate_each=False)
+        exp_len = sequence.rx[1] #the number of samples for the full experiment
+        shot.mark("waveform")
+
+        params = dict(f0=f0, t90=t90, gain=gain, tr=tr, npulses=npulses, cycle=cycle, width=width, p90p=p90p,
+                      amp90=amp90, amp180=amp180, gated=gated, integrate=integrate)
+        #Gated shots are recorded as their echo windows once they are processed, other shots as they arrive
+        gate = None
+        dec = None
+        record = None
+        if gated:
+            #Only keep a window around each echo, the full trace is never stored
+            starts = echo_starts(npulses, tr, t90, self.FS, width)
+            gate = EchoGate(starts, width, self.FS, self.TUNE_SHIFT, 3, 20000, integrate=integrate,
+                            on_window=_on_window if on_echo is not None or stop is not None else None)
+            bigbuff = self.buffers.get(min(exp_len, self.GATE_CHUNK), buffer + "_ring")
+        elif rate is not None:
+            #Demodulate, filter and decimate the trace as it arrives, only the decimated samples are kept
+            dec = Decimator(exp_len, self.FS, rate, self.TUNE_SHIFT, cutoff=min(20000, 0.4*rate))
+            bigbuff = self.buffers.get(min(exp_len, self.GATE_CHUNK), buffer + "_ring")
+            record = dec.on_chunk = self._begin_record("ncpmg", dec.nsamps, rate=dec.rate, delay=dec.delay, **params)
+        else:
+            bigbuff = self.buffers.get(exp_len, buffer)
+            record = self._begin_record("ncpmg", exp_len, **params)
+        caldict = dict(self.caldict)
+        phase = [None]
+        cancel = Event()
 
-        tx_streamer = None
-        rx_streamer = None
+        #Receive straight into the experiment buffer, or through the echo gate or the decimator
+        self._run_shot(shot, sequence, f0, gain, bigbuff, on_chunk=gate or dec or record, stop=cancel)
+        if record is not None:
+            record.end()
+        recorder = self.recorder
 
 
         ########################## Post Processing ##########################
-        b, a = sg.butter(3, 20000, fs=self.FS) #Used to be 10000
-        zi = sg.lfilter_zi(b, a)
-
-        t = np.arange(len(bigbuff[0]))/self.FS
-        exp = np.exp(self.TUNE_SHIFT*np.pi*2*1j*t)
-        z, _ = sg.lfilter(b, a, bigbuff[0]*exp, zi=zi*bigbuff[0,0])
-
-        eshift = -np.angle(np.average(z[60:80]))   #phase properly for 500us TE
-        return z*np.exp(1j*eshift)
-
-    def cpmg_phaseloop(self, f0 = None, t90 = None, gain=70, tr=500.02e-6, npulses = 100, cycle_90 = [0,2,0,2], cycle_180 = [1,1,3,3], amp90 = 0.45, amp180 = 0.9, raw=False):
+        def _process():
+            shot.mark("deferred")
+            if gated:
+                eshift = -np.angle(np.average(gate.head[60:80]))   #phase properly for 500us TE
+                if not integrate:
+                    self._track(f0, gate.windows[:20])
+                result = gate.result(eshift)
+                if cancel.is_set():
+                    result = result[:gate.done]   #cancelled, only the echoes that landed
+                if recorder is not None:
+                    recorder.save("ncpmg", result, caldict, eshift=eshift, **params)
+                shot.mark("process")
+                shot.finish()
+                return result
+
+            if dec is not None:
+                #Already demodulated and filtered, in a new array for this shot
+                z = dec.out
+                eshift = -np.angle(np.average(z[dec.index(60):dec.index(80) + 1]))
+                z *= np.complex64(np.exp(1j*eshift))
+
+                self._track(f0, echo_windows(z, tr, t90, dec.rate, min(npulses, 20), max(2, 200 // dec.factor), dec.delay)[0])
+                shot.mark("process")
+                shot.finish()
+                return z
+
+            #Demodulate into a new array, then filter and phase it in place
+            z = demodulate(bigbuff[0], self.TUNE_SHIFT, self.FS)
+            lowpass(z, 3, 20000, self.FS, out=z) #Used to be 10000
+
+            eshift = -np.angle(np.average(z[60:80]))   #phase properly for 500us TE
+            z *= np.complex64(np.exp(1j*eshift))
+
+            self._track(f0, echo_windows(z, tr, t90, self.FS, min(npulses, 20), 200)[0])
+            shot.mark("process")
+            shot.finish()
+            return z
 
+        #Deferred processing has to finish before the next shot that uses the same buffer
+        return _process if deferred else _process()
+
+    def echo_stream(self, stop = None, **kwargs):
+        #Generator version of ncpmg(gated=True, on_echo=...): runs one CPMG shot in the background and yields
+        #(k, echo) as each echo lands. Closing the generator early (e.g. breaking out of the loop) cancels the rest
+        #of the train like stop does. The keyword arguments go to ncpmg().
+        echoes = Queue()
+        closed = Event()
+        done = object()
+        error = [None]
+
+        def _stop(k, echo):
+            return closed.is_set() or (stop is not None and stop(k, echo))
+
+        def _run():
+            try:
+                self.ncpmg(gated=True, on_echo=lambda k, echo: echoes.put((k, echo)), stop=_stop, **kwargs)
+            except Exception as e:
+                error[0] = e
+            finally:
+                echoes.put(done)
+
+        thread = Thread(target=_run, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = echoes.get()
+                if item is done:
+                    break
+                yield item
+        finally:
+            closed.set()
+            thread.join()
+        if error[0] is not None:
+            raise error[0]
+
+    def cpmg_phaseloop(self, f0 = None, t90 = None, gain=70, tr=500.02e-6, npulses = 100, cycle_90 = [0,2,0,2], cycle_180 = [1,1,3,3], amp90 = 0.45, amp180 = 0.9, raw=False, recovery=3, rate=None):
+        self.ready()
         if f0 is None:
             f0 = self.caldict["f0"]
         if t90 is None:
             t90 = self.caldict["t90"]
 
-        cpdatas = np.zeros((len(cycle_90), int(((npulses + 1) * tr + t90)*self.FS)), dtype=np.complex64)
-        cpdata = np.zeros(int(((npulses + 1) * tr + t90)*self.FS), dtype=np.complex64)
-        for i in range(len(cycle_90)):
-            cpdata = self.ncpmg(gain = 70, tr=tr, npulses=npulses, cycle=[cycle_180[i] for j in range(4)], 
-                                width=4, p90p = cycle_90[i], amp90=amp90, amp180=amp180)
-            cpdatas[i] = cpdata
-            print(i)
-            if(i != len(cycle_90)): time.sleep(3)
+        #Echo amplitudes only need a window around each echo, so gate the acquisition unless the raw data is wanted.
+        #Raw traces are decimated to rate as they arrive if it is given.
+        width = 200
+
+        #Each shot starts `recovery` seconds after the previous one ended, and is processed while the next one waits
+        with ShotScheduler(recovery, last_end=self.last_shot_end) as scheduler:
+            shots = []
+            for i in range(len(cycle_90)):
+                shots.append(scheduler.submit(lambda slot: self.ncpmg(f0 = f0, t90 = t90, gain = 70, tr=tr, npulses=npulses, 
+                                    cycle=[cycle_180[i] for j in range(4)], width=width, p90p = cycle_90[i], amp90=amp90, 
+                                    amp180=amp180, gated=not raw, deferred=True, buffer="cpmg%d" % slot, rate=rate)))
+                print(i)
+            cpdatas = np.stack([s.result() for s in shots])
+        self.last_shot_end = scheduler.last_end
         
         if raw:
             return cpdatas
         else:
             #get echo magnitudes
-            width = 200
-            tr_samps = tr*self.FS
-            t90_samps = int(t90 * self.FS)
-            mags_abs = np.zeros(npulses)
-            mags_r = np.zeros(npulses)
-            
-            for i in range(npulses):
-                start = int((i+1) * tr_samps - width/2) + t90_samps
-                mags_abs[i] = np.max(np.abs(np.sum(cpdatas[:,start:start+width],axis=0)))
-                #mags_r[i] = np.max(np.real(cpdatas[start:start+width]))
-
+            mags_abs, mags_r, mags_mf = combine_echoes(cpdatas)
             return mags_abs
         
+    def look_locker(self, f0 = None, t90 = None, gain = 70, alpha = 10, spacing = 5e-3, npulses = 200, t0 = None, width = 200, amp90 = 1, spoil = False, invert = True, recovery = 3):
+        #Single shot T1 measurement: invert once, then sample the recovery with a train of small flip angle pulses
+        #and keep a window of the FID after each of them, in one acquisition. The fit assumes the sample was fully
+        #recovered, so the inversion waits until `recovery` seconds after the previous shot ended.
+        self.ready()
+        if f0 is None:
+            f0 = self.caldict["f0"]
+        if t90 is None:
+            t90 = self.caldict["t90"]
+        if t0 is None:
+            t0 = spacing
+        shot = self._shot("look_locker")
+
+        #Readout pulses are t90 long with the amplitude scaled to alpha. With spoil, their phase (and the receiver
+        #phase) is advanced by 117 degree steps quadratically, so that no echoes of earlier readouts build up.
+        t180 = 2*t90 if invert else 0
+        times = t0 + spacing * np.arange(npulses)
+        n = np.arange(npulses)
+        phases = (117/90 * n * (n + 1) / 2) % 4 if spoil else np.zeros(npulses)
+        amp = amp90 * alpha / 90
+
+        #The FID window of each readout starts once the receiver has recovered from its pulse
+        start = 0.1
+        rx_start = start - t180/2 - 100e-6
+        starts = ((times + t90/2 + self.DEAD_TIME + 20e-6 - (rx_start - start)) * self.FS).astype(np.int64)
+        exp_len = int(starts[-1] + width + 100)
+        gate = EchoGate(starts, width, self.FS, self.TUNE_SHIFT, 3, 20000)
+        bigbuff = self.buffers.get(min(exp_len, self.GATE_CHUNK), "look_locker_ring")
+        params = dict(f0=f0, t90=t90, gain=gain, alpha=alpha, spacing=spacing, npulses=npulses, t0=t0, width=width,
+                      amp90=amp90, spoil=spoil, invert=invert)
+
+        sequence = look_locker_train(start, t180, amp90, t90, amp, tuple(times), tuple(phases), self.FS, self.TUNE_SHIFT,
+                                     self.ZBUFF_TIME, self.DEAD_TIME, (rx_start, exp_len))
+        shot.mark("waveform")
+
+        self._run_shot(shot, sequence, f0, gain, bigbuff, on_chunk=gate, recovery=recovery)
+
+        ########################## Post Processing ##########################
+        #Undo the receiver phase of each readout, then phase the train so that the recovered end is positive
+        windows = gate.windows * np.exp(-1j*np.pi/2*phases).astype(np.complex64)[:, None]
+        readouts = np.mean(windows, axis=1)
+        phase = -np.angle(np.sum(readouts[-max(1, npulses//4):]))
+        signal = np.real(readouts * np.exp(1j*phase))
+
+        if self.recorder is not None:
+            self.recorder.save("look_locker", gate.windows, self.caldict, eshift=phase, **params)
+        self._track(f0, windows[-min(npulses, 20):])
+
+        #T1 from the fitted inversion depth, which does not depend on the actual flip angle of the readouts (B1
+        #errors, leftover transverse magnetization), and from the nominal flip angle
+        t1, t1_err, fit, fit_err = fit_look_locker(signal, spacing, None, t0)
+        t1_alpha = fit_look_locker(signal, spacing, alpha, t0)[0]
+        alpha_eff = np.degrees(np.arccos(np.clip(np.exp(spacing * (1/t1 - 1/fit[2])), -1, 1)))
+        shot.mark("process")
+        shot.finish()
+        return {"t1": t1, "t1_err": t1_err, "t1_alpha": t1_alpha, "alpha_eff": alpha_eff, "t1_star": fit[2],
+                "a": fit[0], "b": fit[1], "times": times, "signal": signal}
+
+    def average(self, sequence = "onepulse", nshots = 100, target_snr = None, t2_tol = None, recovery = 3, debug = False, window = None, **kwargs):
+        #Repeat a sequence and average its results in place, optionally stopping once the SNR or the relative
+        #standard error of T2 reaches its target. kwargs are passed to the sequence. The SNR is measured over window
+        #of the result, by default the part of a onepulse, pulseecho or ncpmg trace that holds the signal rather than
+        #the pulses leaking into the receiver.
+        shot = getattr(self, sequence) if isinstance(sequence, str) else sequence
+        if t2_tol is not None and "tr" not in kwargs:
+            raise ValueError("t2_tol needs the echo spacing tr")
+        params = inspect.signature(shot).bind_partial(**kwargs)
+        params.apply_defaults()
+        params = params.arguments
+
+        avg = RunningAverage()
+        with ShotScheduler(recovery, last_end=self.last_shot_end) as scheduler:
+            for i in range(nshots):
+                avg.add(scheduler.run(lambda: shot(**kwargs)))
+                if i == 0 and window is None:
+                    window = self._signal_window(getattr(shot, "__name__", None), params, avg.mean.shape[-1])
+                snr = avg.snr(window)
+                if debug:
+                    print("%d shots, SNR %f" % (avg.n, snr))
+                if target_snr is not None and snr >= target_snr:
+                    break
+                if t2_tol is not None and i == 0 and (avg.mean.ndim != 1 or len(avg.mean) != params.get("npulses")):
+                    raise ValueError("t2_tol needs a sequence returning one value per echo, e.g. ncpmg with gated=True, integrate=True")
+                if t2_tol is not None and avg.n >= 2:
+                    t2, t2_err = fit_t2_error(avg.mean, kwargs["tr"], avg.stderr())
+                    if debug:
+                        print("T2 = %f +/- %f" % (t2, t2_err))
+                    if t2_err < t2_tol * t2:
+                        break
+        self.last_shot_end = scheduler.last_end
+        return avg
+        
+    def record(self, path, **meta):
+        #Write every following shot to a recording at path, until stop_recording() is called
+        self.stop_recording()
+        self.recorder = Recorder(path, FS=self.FS, TUNE_SHIFT=self.TUNE_SHIFT, RX_GAIN=self.RX_GAIN, **meta)
+        return self.recorder
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
     def find_f0(self, t90 = None, gain = 70, freq = None, debug=False):
+        self.ready()
         if freq is None:
             freq = self.caldict["f0"]
         if t90 is None:
             t90 = self.caldict["t90"]
 
         echo = self.pulseecho(gain=70, amp90=0.45, amp180=0.9)[4000:8000]
-        efft = np.fft.fft(echo)
-
-        ftfreqs = np.fft.fftfreq(4000, self.FS)
-        maxfreq = ftfreqs[np.argmax(np.fft.fftshift(np.abs(efft)))-2000]
-        f0 = freq + maxfreq
+        f0 = freq + peak_frequency(echo, self.FS)
 
         if(debug):
             print(f0)
 
         return f0
     
-    def find_t90(self, f0 = None, gain = 70, debug = False):
+    def find_t90(self, f0 = None, gain = 70, debug = False, tol = 1e-6, max_shots = 16, recovery = 4, t90_range = (5e-6, 100e-6)):
+        self.ready()
         if f0 is None:
             f0 = self.caldict["f0"]
 
         if debug:
             print("Calibrating t90")
 
-        def _weight(fid):
+        def _weight(fid, t90):
+            fidstart_idx = int((self.DEAD_TIME + t90 + 100e-6)*self.FS) + 500 #extra 500 for lowpass filter
             return np.max(np.abs(fid[fidstart_idx:fidstart_idx+3000]))
 
-        t90s = np.arange(5e-6, 100e-6, 5e-6)
-        scores = np.zeros(len(t90s))
-        for i in range(len(t90s)):
-            fidstart_idx = int((self.DEAD_TIME + t90s[i] + 100e-6)*self.FS) + 500 #extra 500 for lowpass filter
+        def _shot(t90):
+            #Let the sample recover from the previous shot
+            if self.last_shot_end is not None:
+                time.sleep(max(0, self.last_shot_end + recovery - time.monotonic()))
             if debug:
-                print("Testing %fs" % (t90s[i]))
-            fid = self.onepulse(f0, t90s[i], gain)
-            scores[i] = _weight(fid)
+                print("Testing %fs" % (t90))
+            fid = self.onepulse(f0, t90, gain)
+            t90s.append(t90)
+            scores.append(_weight(fid, t90))
             if debug:
-                print(scores[i])
-            time.sleep(4)
-        return np.stack((t90s, scores), axis=1)
+                print(scores[-1])
+
+        #Step up from the shortest pulse until the FID amplitude falls past the first maximum of the nutation curve,
+        #then points around the fitted t90 are added until its standard error is below tol
+        t90s = []
+        scores = []
+        t90 = t90_range[0]
+        while len(t90s) < max_shots:
+            _shot(np.round(t90 * self.FS) / self.FS)
+            if scores[-1] < SWEEP_DROP * max(scores) or t90 >= 2*t90_range[1]:
+                break
+            t90 = min(t90 * SWEEP_RATIO, 2*t90_range[1])
+
+        fit = fit_nutation(t90s, scores, t90_range)
+        step = 0
+        while len(t90s) < max_shots and (fit is None or fit[1][1] > tol or step < 2):
+            estimate = t90s[np.argmax(scores)] if fit is None else fit[0][1]
+            _shot(next_nutation_point(estimate, step, self.FS, t90_range))
+            fit = fit_nutation(t90s, scores, t90_range)
+            step += 1
+
+        t90s = np.array(t90s)
+        scores = np.array(scores)
+        if fit is None:
+            #Fall back to the best point
+            best = t90s[np.argmax(scores)]
+            return {"t90": best, "t90_err": np.inf, "t90s": t90s, "scores": scores, "params": None, "curve": None}
+
+        popt, perr = fit
+        t = np.linspace(t90_range[0], t90_range[1], 200)
+        if debug:
+            print("t90 = %fs +/- %fs" % (popt[1], perr[1]))
+        return {"t90": popt[1], "t90_err": perr[1], "t90s": t90s, "scores": scores, "params": popt,
+                "curve": np.stack((t, nutation_model(t, *popt)), axis=1)}
     
     def get_t2(self, cpdata, tr=None):
-        def _decay(x, a, b, c):
-            return a * np.exp(-b * x)+c
-        
-        if tr is None:
-            popt, pcov = opt.curve_fit(_decay, cpdata[:,0], cpdata[:,1])
-        else:
-            popt, pcov = opt.curve_fit(_decay, np.arange(len(cpdata))*tr, cpdata)
-            
-        return 1/popt[1]
+        return get_t2(cpdata, tr)
     
-    def cal(self, f0=None, t90=None, debug=False):
+    def cal(self, f0=None, t90=None, debug=False, recovery=4):
+        self._calibrating = True
+        try:
+            self._cal(f0, t90, debug, recovery)
+        finally:
+            self._calibrating = False
+
+    def _cal(self, f0, t90, debug, recovery):
         if f0 is None and t90 is None:
             self.caldict["f0"] = self.find_f0()
-            tfids = self.find_t90(debug=debug)
-            self.caldict["t90"] = tfids[np.argmax(tfids[:,1]),0]
+            self.caldict["t90"] = self.find_t90(debug=debug, recovery=recovery)["t90"]
             self.caldict["lastcal"] = time.time()
         else:
             if f0 is not None and t90 is not None:
@@ -525,34 +643,150 @@ class SDMRR:
                 self.caldict["f0"] = f0
             elif f0 is not None:
                 self.caldict["f0"] = f0
-                tfids = self.find_t90()
-                self.caldict["t90"] = tfids[np.argmax(tfids[:,1]),0]
+                self.caldict["t90"] = self.find_t90(recovery=recovery)["t90"]
                 self.caldict["lastcal"] = time.time()
             elif t90 is not None:
                 self.caldict["t90"] = t90
                 self.caldict["f0"] = self.find_f0()
+
+        #Drift is tracked from the new calibration
+        if self.tracker is not None:
+            self.tracker.reset(self.caldict["f0"])
+        self._recal = False
         
         json_object = json.dumps(self.caldict, indent=4)
-        with open("cal.json", "w") as cal:
+        with open(self.cal_path, "w") as cal:
             cal.write(json_object)
             
     
     def check_cal(self, debug = False):
-        if(time.time() - self.caldict["lastcal"] > 5*60): #longer than 5 minutes since last cal
+        if self.tracker is not None and self.tracker.tracking():
+            #f0 is being followed between shots, only recalibrate if the tracker lost it or it drifted too far
+            if not self.tracker.needs_cal():
+                return True
+            if debug:
+                print("Frequency drifted by %f Hz, running calibration" % (self.tracker.drift))
+        elif(time.time() - self.caldict["lastcal"] > 5*60): #longer than 5 minutes since last cal
             if debug:
                 print("Calibration out of date, running calibration")
-            self.cal()
-            return False
-        return True
+        else:
+            return True
+        self.cal()
+        return False
+
+    def _run_shot(self, shot, sequence, f0, gain, buff, on_chunk = None, stop = None, recovery = None):
+        #Play a compiled sequence at f0 and receive its acquisition window into buff, which is reused as a ring if it
+        #is shorter. on_chunk(start, chunk) gets each chunk from the receiving thread as it lands. Once the stop event
+        #is set, the rest of the sequence is dropped and the stream is stopped. With recovery, the shot starts that
+        #many seconds after the previous one ended. Sets last_shot_end, and returns the number of samples received.
+        nsamps = sequence.rx[1]
+        stopped = [False]
+        self.radio.set_gpio_attr('FP0', 'OUT', 0x002, 0xFFF) #pin 2 ON
+
+        def _on_chunk(start, chunk):
+            if on_chunk is not None:
+                on_chunk(start, chunk)
+            if stop.is_set() and not stopped[0]:
+                stopped[0] = True
+                sequence.stop_rx(rx_streamer, self.lib)
+
+        def _rx():
+            rx_start = time.perf_counter()
+            received[0] = receive(rx_streamer, buff, self.uhd.types.RXMetadata(), on_chunk=on_chunk if stop is None else _on_chunk,
+                                  nsamps=nsamps, stats=shot)
+            shot.add_time("rx", time.perf_counter() - rx_start)
+
+        #Set up the streamers before we start receiving, as this setup causes the radio to stop RX
+        tx_streamer = self.session.tx_streamer()
+        rx_streamer = self.session.rx_streamer()
+        shot.mark("setup")
+
+        #Set up TX and RX, only changed settings are sent to the radio
+        self.session.tune(self.FS, f0 + 120e6 + self.TUNE_SHIFT, gain, f0 + 120e6 + self.TUNE_SHIFT, self.RX_GAIN)
+        shot.mark("tune")
+
+        if recovery is not None and self.last_shot_end is not None:
+            time.sleep(max(0, self.last_shot_end + recovery - time.monotonic()))
+            shot.mark("recovery")
+
+        #Reset time to 0, then stream TX from this thread while RX is received in another
+        self.radio.set_time_now(self.lib.types.time_spec(0.0))
+        received = [0]
+        rx_thread = Thread(target=_rx, args=())
+        sequence.start_rx(rx_streamer, self.lib, shot)
+        rx_thread.start()
+
+        tx_end = sequence.play(self.radio, tx_streamer, self.lib, shot, stop=stop)
+
+        rx_thread.join()
+        if stopped[0]:
+            #Stopped on purpose, so the streamers are fine and are kept. The TX samples already queued still play,
+            #let them out before the next shot resets the clock, and drop the RX samples left after the stop.
+            delay = tx_end - self.radio.get_time_now().get_real_secs()
+            if delay > 0:
+                time.sleep(delay)
+            metadata = self.uhd.types.RXMetadata()
+            while rx_streamer.recv(buff, metadata, 0.01):
+                pass
+        self.last_shot_end = time.monotonic()
+        shot.mark("rx_wait")
+        self.radio.set_gpio_attr('FP0', 'OUT', 0x002, 0xFFF) #pin 2 ON
+        if received[0] < nsamps and not stopped[0]:
+            self.session.reset() #start from fresh streamers if the stream did not finish
+        shot.tx_async(tx_streamer, self.uhd.types.TXAsyncMetadata())
+        shot.mark("tx_async")
+        return received[0]
+
+    def _signal_window(self, name, params, length):
+        #Mask of the samples of a sequence's trace that hold signal, leaving out the pulses leaking into the receiver
+        #and the dead time after them. None for results without pulses in them, e.g. echo windows or amplitudes.
+        t90 = params.get("t90") or self.caldict["t90"]
+        if name == "onepulse":
+            start = int((self.DEAD_TIME + t90 + 100e-6)*self.FS) + 500 #extra 500 for lowpass filter
+            return slice(start, start + 3000)
+        if name == "pulseecho" or (name == "ncpmg" and not params["gated"]):
+            #A window around each echo, in the samples of the decimated trace if it is decimated
+            width = 400
+            index = (lambda n: n) if params["rate"] is None else Decimator(0, self.FS, params["rate"], 0).index
+            mask = np.zeros(length, dtype=bool)
+            for start in echo_starts(params.get("npulses", 1), params["tr"], t90, self.FS, width):
+                mask[index(start):index(start + width)] = True
+            return mask
+        return None
+
+    def _shot(self, sequence):
+        #Metrics of a new shot, or a stand-in that does nothing if metrics are off
+        return NULL_SHOT if self.metrics is None else self.metrics.shot(sequence)
+
+    def _begin_record(self, name, nsamps, **params):
+        #Writer for the raw samples of a shot, or None if not recording
+        if self.recorder is None:
+            return None
+        return self.recorder.begin(name, nsamps, caldict=self.caldict, rx_gain=self.RX_GAIN, **params)
+
+    def _track(self, f0, segments):
+        #Update the f0 calibration from the phase evolution of demodulated data acquired at f0
+        if self.tracker is not None:
+            offset, quality = frequency_offset(segments, self.FS)
+            self.caldict["f0"] = self.tracker.update(self.caldict["f0"], f0 + offset, quality)
+            if self.tracker.needs_cal() and not self._calibrating and not self._recal:
+                #Not from here, this may be the middle of a shot or another thread. ready() runs it.
+                print("Tracked f0 drifted by %f Hz or was lost, calibrating before the next acquisition" % (self.tracker.drift))
+                self._recal = True
             
 class HiddenPrints:
+    #sys.stdout is shared by the whole process, so prints are only hidden on the main thread. Swapping it from
+    #another thread (e.g. the startup calibration) would swallow what the main thread prints.
     def __enter__(self):
-        self._original_stdout = sys.stdout
-        sys.stdout = open(os.devnull, 'w')
+        self._original_stdout = None
+        if current_thread() is main_thread():
+            self._original_stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        sys.stdout.close()
-        sys.stdout = self._original_stdout
+        if self._original_stdout is not None:
+            sys.stdout.close()
+            sys.stdout = self._original_stdout
 
 
 
@@ -1 +1,10 @@
-from sdmrr.SDMRR import *
\ No newline at end of file
+from sdmrr.SDMRR import *
+from sdmrr.sim import SimulatedUHD, SpinModel
+from sdmrr.echoes import echo_windows, combine_echoes, EchoStop
+from sdmrr.recorder import Recorder, Recording
+from sdmrr.fitting import fit_mono, fit_bi, fit_look_locker, t2_distribution
+from sdmrr.rack import Rack
+from sdmrr.metrics import Metrics, ShotMetrics
+from sdmrr.sequence import Sequence, CompiledSequence
+from sdmrr.receive import Decimator
+from sdmrr.server import Server, Client
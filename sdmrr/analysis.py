@@ -0,0 +1,30 @@
+import numpy as np
+
+# Everything needed to process data after it was acquired, without the radio. Nothing imported from here touches
+# uhd, so analysis hosts and worker processes can use it without the driver installed. scipy is only imported
+# by the functions that use it, when they are first called.
+
+from sdmrr.dsp import demodulate, lowpass, lowpass_sos, decimation_taps, peak_frequency
+from sdmrr.receive import Decimator
+from sdmrr.echoes import echo_starts, echo_windows, combine_echoes, EchoStop
+from sdmrr.fitting import fit_mono, fit_bi, fit_look_locker, t2_distribution
+from sdmrr.averaging import RunningAverage, fit_t2_error
+from sdmrr.tracking import frequency_offset
+from sdmrr.nutation import fit_nutation, nutation_model
+from sdmrr.recorder import Recording
+
+def get_t2(cpdata, tr = None):
+    #Fit an exponential to echo amplitudes and return T2. cpdata is either a 2D array of (time, amplitude) rows,
+    #or a 1D array of amplitudes spaced by tr.
+    if tr is None:
+        import scipy.optimize as opt
+
+        def _decay(x, a, b, c):
+            return a * np.exp(-b * x)+c
+
+        popt, pcov = opt.curve_fit(_decay, cpdata[:,0], cpdata[:,1])
+        return 1/popt[1]
+
+    #Evenly spaced echoes, use the batch fitter for its starting guess
+    popt, perr = fit_mono(cpdata, tr)
+    return popt[1]
@@ -0,0 +1,62 @@
+import numpy as np
+
+class RunningAverage:
+    #Welford running mean and variance of repeated shots, per sample (or per echo). The sums are updated in place,
+    #so memory does not grow with the number of shots. Complex data is averaged coherently.
+
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+        self._delta = None
+
+    def add(self, x):
+        x = np.asarray(x)
+        if self.mean is None:
+            dtype = np.complex128 if np.iscomplexobj(x) else np.float64
+            self.mean = np.zeros(x.shape, dtype=dtype)
+            self.m2 = np.zeros(x.shape)
+            self._delta = np.empty(x.shape, dtype=dtype)
+        self.n += 1
+        np.subtract(x, self.mean, out=self._delta)
+        self.mean += self._delta / self.n
+        #m2 += (x - old mean) * conj(x - new mean)
+        self.m2 += np.real(self._delta * np.conj(x - self.mean))
+
+    def variance(self):
+        #Per sample variance of a single shot
+        if self.n < 2:
+            return np.full(self.m2.shape, np.inf)
+        return self.m2 / (self.n - 1)
+
+    def stderr(self):
+        #Per sample standard error of the mean
+        return np.sqrt(self.variance() / self.n)
+
+    def snr(self, window = None):
+        #Peak of the averaged signal over its average standard error, within window (a slice, index array or mask of
+        #the samples, e.g. to leave out the pulses) or over all of them
+        if self.n < 2:
+            return 0.0
+        if window is None:
+            window = slice(None)
+        noise = np.sqrt(np.mean(self.variance()[..., window]) / self.n)
+        return float(np.max(np.abs(self.mean[..., window])) / noise) if noise > 0 else np.inf
+
+def fit_t2_error(mags, tr, sigma = None):
+    #Mono-exponential fit of averaged echo amplitudes. Returns T2 and its standard error, or (nan, inf) if the fit fails.
+    mags = np.abs(np.asarray(mags))
+    t = np.arange(len(mags)) * tr
+    p0 = [mags[0], 1 / (len(mags) * tr / 3), 0]
+    if sigma is not None:
+        sigma = np.maximum(sigma, np.max(sigma) * 1e-6)
+    import scipy.optimize as opt
+    try:
+        popt, pcov = opt.curve_fit(lambda x, a, b, c: a * np.exp(-b * x) + c, t, mags, p0=p0, sigma=sigma,
+                                   absolute_sigma=sigma is not None)
+    except (RuntimeError, ValueError):
+        return np.nan, np.inf
+    if popt[1] <= 0 or not np.isfinite(pcov[1, 1]):
+        return np.nan, np.inf
+    #T2 = 1/b, so its error is err(b)/b^2
+    return 1 / popt[1], np.sqrt(pcov[1, 1]) / popt[1]**2
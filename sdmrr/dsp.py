@@ -0,0 +1,81 @@
+import numpy as np
+from functools import lru_cache
+
+NCO_BLOCK = 4096        # Length of the cached phasor table
+FILTER_BLOCK = 65536    # Samples filtered at a time, bounds the temporaries of the in-place path
+
+@lru_cache(maxsize=32)
+def _phasor_table(n, shift, fs):
+    table = np.exp(2j*np.pi*shift*np.arange(n)/fs).astype(np.complex64)
+    table.flags.writeable = False
+    return table
+
+def demodulate(x, shift, fs, start = 0, out = None):
+    #Multiply x by exp(2j*pi*shift*t), where t = (start + index)/fs, in complex64.
+    #The trace is handled as blocks of a cached phasor table, each rotated by a phase computed in float64,
+    #so no trace-length temporaries are made. Pass out=x to demodulate in place.
+    x = np.ascontiguousarray(x, dtype=np.complex64)
+    n = len(x)
+    if out is None:
+        out = np.empty(n, dtype=np.complex64)
+    table = _phasor_table(NCO_BLOCK, shift, fs)
+
+    nblocks = n // NCO_BLOCK
+    bulk = nblocks * NCO_BLOCK
+    if nblocks:
+        blocks = out[:bulk].reshape(nblocks, NCO_BLOCK)
+        np.multiply(x[:bulk].reshape(nblocks, NCO_BLOCK), table, out=blocks)
+        cycles = (shift * (start + NCO_BLOCK*np.arange(nblocks)) / fs) % 1
+        blocks *= np.exp(2j*np.pi*cycles).astype(np.complex64)[:, None]
+    if bulk < n:
+        rotation = np.complex64(np.exp(2j*np.pi*((shift * (start + bulk) / fs) % 1)))
+        np.multiply(x[bulk:], table[:n - bulk], out=out[bulk:])
+        out[bulk:] *= rotation
+    return out
+
+@lru_cache(maxsize=32)
+def lowpass_sos(order, cutoff, fs):
+    #Butterworth lowpass in second-order sections. The coefficients are single precision so that filtering
+    #complex64 data stays in complex64.
+    import scipy.signal as sg
+    sos = sg.butter(order, cutoff, fs=fs, output='sos').astype(np.float32)
+    sos.flags.writeable = False
+    return sos
+
+@lru_cache(maxsize=32)
+def _sos_zi(order, cutoff, fs):
+    import scipy.signal as sg
+    zi = sg.sosfilt_zi(lowpass_sos(order, cutoff, fs)).astype(np.complex64)
+    zi.flags.writeable = False
+    return zi
+
+def lowpass(x, order, cutoff, fs, out = None, zi = None):
+    #Apply a cached Butterworth lowpass to x in blocks, carrying the filter state between them.
+    #If zi is None the filter starts in steady state for x[0], like lfilter_zi(b, a)*x[0].
+    #Pass out=x to filter in place. Returns the filtered data and the final filter state.
+    import scipy.signal as sg
+    sos = lowpass_sos(order, cutoff, fs)
+    if out is None:
+        out = np.empty(len(x), dtype=np.complex64)
+    if zi is None:
+        zi = _sos_zi(order, cutoff, fs) * (x[0] if len(x) else 0)
+    for i in range(0, len(x), FILTER_BLOCK):
+        out[i:i+FILTER_BLOCK], zi = sg.sosfilt(sos, x[i:i+FILTER_BLOCK], zi=zi)
+    return out, zi
+
+def peak_frequency(x, fs):
+    #Frequency of the largest FFT bin of x, resolved to fs/len(x)
+    spectrum = np.fft.fft(x)
+    return np.fft.fftfreq(len(x), 1/fs)[np.argmax(np.abs(spectrum))]
+
+@lru_cache(maxsize=32)
+def decimation_taps(factor, cutoff, fs, taps_per_phase = 16):
+    #Linear phase lowpass FIR (Kaiser window) of taps_per_phase*factor taps for decimating by factor, split into
+    #its polyphase components. Row l holds taps l*factor ... (l+1)*factor-1 reversed, so that the output at the end
+    #of a block of factor input samples is the sum over l of the block l blocks back dotted with row l.
+    import scipy.signal as sg
+    ntaps = taps_per_phase * factor
+    taps = sg.firwin(ntaps, cutoff, window=('kaiser', 8.0), fs=fs)
+    phases = taps.reshape(taps_per_phase, factor)[:, ::-1].astype(np.complex64)
+    phases.flags.writeable = False
+    return phases
@@ -0,0 +1,66 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+def echo_starts(npulses, tr, t90, fs, width, delay = 0):
+    #First sample of the window around each CPMG echo. delay is how many samples the trace lags behind the
+    #acquisition, e.g. Decimator.delay for a decimated trace.
+    return (np.arange(1, npulses + 1) * (tr*fs) - width/2 + delay).astype(np.int64) + int(t90 * fs)
+
+def echo_windows(traces, tr, t90, fs, npulses, width = 200, delay = 0):
+    #Cut the window around each echo out of one trace, or a (ncycles, nsamps) stack of traces, and return them as
+    #an (ncycles, npulses, width) array. Only the windows are read, so traces can be a np.load(..., mmap_mode='r') array.
+    traces = np.asarray(traces)
+    if traces.ndim == 1:
+        traces = traces[None, :]
+    starts = echo_starts(npulses, tr, t90, fs, width, delay)
+    return sliding_window_view(traces, width, axis=-1)[:, starts, :]
+
+def combine_echoes(windows, weights = None, template = None):
+    #Combine (ncycles, npulses, width) echo windows over the phase cycle with the receiver weights (complex, one
+    #per cycle step, plain sum if None), then measure every echo at once.
+    #Returns the peak magnitude, the peak real part and the matched filter amplitude of each echo. The matched filter
+    #uses template (width samples), or the average echo if None, and is scaled to match the peak magnitude.
+    windows = np.asarray(windows)
+    if windows.ndim == 2:
+        windows = windows[None, :, :]
+    if weights is None:
+        echoes = np.sum(windows, axis=0)
+    else:
+        echoes = np.einsum('c,cpw->pw', np.asarray(weights, dtype=np.complex64), windows)
+
+    mags_abs = np.max(np.abs(echoes), axis=1)
+    mags_r = np.max(np.real(echoes), axis=1)
+
+    if template is None:
+        template = np.mean(echoes, axis=0)
+    template = np.asarray(template)
+    scale = np.max(np.abs(template)) / np.real(np.vdot(template, template))
+    mags_mf = np.real(echoes @ np.conj(template)) * scale
+    return mags_abs, mags_r, mags_mf
+
+class EchoStop:
+    #Stop condition for echoes streamed from ncpmg(): true once `count` echoes in a row have an amplitude (magnitude
+    #of the mean of the window) below k times the noise, after at least min_echoes echoes. Unless noise is given, it
+    #is estimated from the differences between consecutive echoes over the last `history` echoes, using their median
+    #so the decay and the phase cycle barely count. Keeps state, so use a new one for each shot.
+
+    def __init__(self, k = 3, count = 3, min_echoes = 10, noise = None, history = 20):
+        self.k = k
+        self.count = count
+        self.min_echoes = min_echoes
+        self.noise = noise
+        self.history = history
+        self.means = []
+        self._below = 0
+
+    def __call__(self, index, echo):
+        self.means.append(np.mean(echo))
+        if len(self.means) < self.min_echoes:
+            return False
+        noise = self.noise
+        if noise is None:
+            #Per quadrature noise of one echo: the squared magnitude of a difference has median 4*ln(2)*noise**2
+            d = np.diff(self.means[-self.history - 1:])
+            noise = np.sqrt(np.median(np.abs(d)**2) / (4*np.log(2)))
+        self._below = self._below + 1 if abs(self.means[-1]) < self.k * noise else 0
+        return self._below >= self.count
@@ -0,0 +1,250 @@
+import numpy as np
+from functools import lru_cache
+
+# Relaxation fits for whole batches of decays. Echo i of a decay is at time i*tr, like in SDMRR.get_t2.
+# The exponential fits run Levenberg-Marquardt on every decay of the batch at once, with the decay rates
+# (1/T2) as the internal parameters so that they can be kept positive.
+
+def _mono(t, p):
+    #a*exp(-b*t) + c and its Jacobian, with the parameters along axis 1
+    jac = np.empty((len(p), 3, len(t)))
+    e = np.exp(-p[:, 1, None] * t, out=jac[:, 0])
+    f = p[:, 0, None] * e + p[:, 2, None]
+    np.multiply(-t, f - p[:, 2, None], out=jac[:, 1])
+    jac[:, 2] = 1
+    return f, jac
+
+def _bi(t, p):
+    #a1*exp(-b1*t) + a2*exp(-b2*t) + c and its Jacobian, with the parameters along axis 1
+    jac = np.empty((len(p), 5, len(t)))
+    e1 = np.exp(-p[:, 1, None] * t, out=jac[:, 0])
+    e2 = np.exp(-p[:, 3, None] * t, out=jac[:, 2])
+    np.multiply(-t * p[:, 0, None], e1, out=jac[:, 1])
+    np.multiply(-t * p[:, 2, None], e2, out=jac[:, 3])
+    jac[:, 4] = 1
+    f = p[:, 0, None] * e1 + p[:, 2, None] * e2 + p[:, 4, None]
+    return f, jac
+
+def _levenberg_marquardt(model, t, y, p, rates, w, max_iter, tol):
+    #Minimize sum(w*(y - model)^2) for every row of y (w = None for equal weights). Steps that increase the cost of a
+    #decay or make one of its rates negative are rejected for that decay only. Decays stop iterating once a step
+    #changes their cost by less than tol relative to it, and are dropped from the arrays the next iterations work on.
+    #Returns the parameters, the Jacobian at the solution and the cost of every decay.
+    def _cost(f, y, w):
+        r2 = (y - f)**2
+        return np.sum(r2 if w is None else w * r2, axis=1)
+
+    f, jac = model(t, p)
+    cost = _cost(f, y, w)
+    p_out, jac_out, cost_out = p.copy(), jac, cost.copy()
+    idx = np.arange(len(y))
+    lam = np.full(len(y), 1e-3)
+    eye = np.eye(p.shape[1])
+    for i in range(max_iter):
+        jw = jac if w is None else jac * w[:, None]
+        jtj = np.einsum('bpn,bqn->bpq', jw, jac)
+        jtr = np.einsum('bpn,bn->bp', jw, y - f)
+        diag = np.einsum('bpp->bp', jtj)
+        damped = jtj + (lam[:, None] * np.maximum(diag, 1e-30))[..., None] * eye
+        try:
+            step = np.linalg.solve(damped, jtr[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            step = (np.linalg.pinv(damped) @ jtr[..., None])[..., 0]
+
+        trial = p + step
+        f_trial, jac_trial = model(t, trial)
+        cost_trial = _cost(f_trial, y, w)
+        accept = (cost_trial <= cost) & np.all(trial[:, rates] > 0, axis=1) & np.isfinite(cost_trial)
+        converged = (np.abs(cost - cost_trial) <= tol * cost) | (lam > 1e10)
+
+        #Usually almost every step is accepted, so take the trial and put back the few rejected decays
+        reject = ~accept
+        trial[reject], f_trial[reject], jac_trial[reject], cost_trial[reject] = p[reject], f[reject], jac[reject], cost[reject]
+        p, f, jac, cost = trial, f_trial, jac_trial, cost_trial
+        lam = np.where(accept, lam / 3, lam * 4)
+
+        if i == max_iter - 1:
+            converged[:] = True
+        if np.any(converged):
+            done = idx[converged]
+            p_out[done], jac_out[done], cost_out[done] = p[converged], jac[converged], cost[converged]
+            keep = ~converged
+            if not np.any(keep):
+                break
+            idx, p, f, jac, cost, lam, y = idx[keep], p[keep], f[keep], jac[keep], cost[keep], lam[keep], y[keep]
+            if w is not None:
+                w = w[keep]
+    return p_out, jac_out, cost_out
+
+def _errors(jac, cost, w, n, absolute):
+    #Standard errors from the Jacobian at the solution. Without absolute weights, the residual variance is used.
+    jtj = np.einsum('bpn,bqn->bpq', jac if w is None else jac * w[:, None], jac)
+    try:
+        cov = np.linalg.inv(jtj)
+    except np.linalg.LinAlgError:
+        cov = np.linalg.pinv(jtj)
+    if not absolute:
+        dof = max(n - jac.shape[1], 1)
+        cov *= (cost / dof)[:, None, None]
+    return np.sqrt(np.abs(np.einsum('bpp->bp', cov)))
+
+def _prepare(y, tr, sigma):
+    y = np.asarray(y, dtype=float)
+    single = y.ndim == 1
+    y = np.atleast_2d(y)
+    t = np.arange(y.shape[1]) * tr
+    if sigma is None:
+        w = None
+    else:
+        w = np.broadcast_to(1 / np.asarray(sigma, dtype=float)**2, y.shape)
+    return y, t, w, single
+
+@lru_cache(maxsize=16)
+def _rate_grid(n, tr, ngrid = 128):
+    #exp(-b*t) for log spaced rates b, from well below the length of the decay to above the echo rate, with the
+    #sums over t needed for the linear part of the fit
+    rates = np.geomspace(1 / (20 * n * tr), 2 / tr, ngrid)
+    grid = np.exp(-np.outer(rates, np.arange(n) * tr))
+    se = np.sum(grid, axis=1)
+    see = np.sum(grid**2, axis=1)
+    for a in (rates, grid, se, see):
+        a.flags.writeable = False
+    return rates, grid, se, see
+
+def _mono_guess(t, y, tr):
+    #For every rate on the grid, a and c follow from linear least squares, so the best rate of every decay comes
+    #from one matrix product. The minimum is refined by a parabola through its neighbours in log(rate).
+    n = y.shape[1]
+    rates, grid, se, see = _rate_grid(n, float(tr))
+    sey = y @ grid.T
+    sy = np.sum(y, axis=1)[:, None]
+    det = see * n - se**2
+    cost = -(n * sey**2 - 2 * se * sey * sy + see * sy**2) / det
+
+    k = np.clip(np.argmin(cost, axis=1), 1, len(rates) - 2)
+    rows = np.arange(len(y))
+    c0, c1, c2 = cost[rows, k - 1], cost[rows, k], cost[rows, k + 1]
+    curvature = c0 - 2*c1 + c2
+    shift = np.where(curvature > 0, 0.5 * (c0 - c2) / np.where(curvature > 0, curvature, 1), 0)
+    b = rates[k] * (rates[1] / rates[0])**np.clip(shift, -1, 1)
+
+    a = (n * sey[rows, k] - se[k] * sy[:, 0]) / det[k]
+    c = (see[k] * sy[:, 0] - se[k] * sey[rows, k]) / det[k]
+    return np.stack((a, b, c), axis=1)
+
+def fit_mono(y, tr, p0 = None, sigma = None, max_iter = 100, tol = 1e-10):
+    #Fit a*exp(-t/T2) + c to one decay or to each row of a 2D batch of decays.
+    #p0 (a, T2, c) per decay warm starts the fit, e.g. from the fits of the previous timepoint. If sigma (the noise
+    #standard deviation, per echo or per decay) is given, the fit is weighted and the errors use it.
+    #Returns the parameters (a, T2, c) and their standard errors, with one row per decay.
+    y, t, w, single = _prepare(y, tr, sigma)
+    if p0 is None:
+        p = _mono_guess(t, y, tr)
+    else:
+        p = np.array(np.broadcast_to(p0, (len(y), 3)), dtype=float)
+        p[:, 1] = 1 / p[:, 1]
+
+    p, jac, cost = _levenberg_marquardt(_mono, t, y, p, [1], w, max_iter, tol)
+    perr = _errors(jac, cost, w, len(t), sigma is not None)
+
+    #T2 = 1/b, so its error is err(b)/b^2
+    perr[:, 1] /= p[:, 1]**2
+    p[:, 1] = 1 / p[:, 1]
+    if single:
+        return p[0], perr[0]
+    return p, perr
+
+def fit_bi(y, tr, p0 = None, sigma = None, max_iter = 200, tol = 1e-10):
+    #Fit a1*exp(-t/T2a) + a2*exp(-t/T2b) + c to one decay or to each row of a batch, with T2a < T2b.
+    #Without p0 (a1, T2a, a2, T2b, c), each fit starts from its mono-exponential fit split into a fast and a slow part.
+    #Returns the parameters and their standard errors, with one row per decay.
+    y, t, w, single = _prepare(y, tr, sigma)
+    if p0 is None:
+        mono, _ = fit_mono(y, tr, sigma=sigma)
+        p = np.stack((mono[:, 0]/2, 3/mono[:, 1], mono[:, 0]/2, 1/(3*mono[:, 1]), mono[:, 2]), axis=1)
+    else:
+        p = np.array(np.broadcast_to(p0, (len(y), 5)), dtype=float)
+        p[:, [1, 3]] = 1 / p[:, [1, 3]]
+
+    p, jac, cost = _levenberg_marquardt(_bi, t, y, p, [1, 3], w, max_iter, tol)
+    perr = _errors(jac, cost, w, len(t), sigma is not None)
+    perr[:, [1, 3]] /= p[:, [1, 3]]**2
+    p[:, [1, 3]] = 1 / p[:, [1, 3]]
+
+    #Put the fast component first
+    swap = p[:, 1] > p[:, 3]
+    p[swap] = p[swap][:, [2, 3, 0, 1, 4]]
+    perr[swap] = perr[swap][:, [2, 3, 0, 1, 4]]
+    if single:
+        return p[0], perr[0]
+    return p, perr
+
+def fit_look_locker(y, spacing, alpha = None, t0 = 0, sigma = None):
+    #T1 from a Look-Locker train: one decay, or each row of a batch, of signed readouts taken every spacing starting
+    #t0 after the inversion. The readouts follow the apparent recovery A - B*exp(-t/T1*), which is faster than T1
+    #because every readout pulse tips away some magnetization. With the flip angle alpha (degrees) of the readout
+    #pulses, 1/T1 = 1/T1* + ln(cos(alpha))/spacing. Without it, T1 = T1*(B/A - 1), which assumes a perfect inversion.
+    #Returns T1 and its standard error, and the fitted (A, B, T1*) and their standard errors, with one row per decay.
+    params, perr = fit_mono(y, spacing, sigma=sigma)
+    params, perr = np.atleast_2d(params), np.atleast_2d(perr)
+    t1_star, t1_star_err = params[:, 1], perr[:, 1]
+    a = params[:, 2]
+    b = -params[:, 0] * np.exp(t0 / t1_star)
+    b_err = perr[:, 0] * np.exp(t0 / t1_star)
+    if alpha is not None:
+        t1 = 1 / (1 / t1_star + np.log(np.cos(np.radians(alpha))) / spacing)
+        t1_err = t1_star_err * (t1 / t1_star)**2
+    else:
+        t1 = t1_star * (b / a - 1)
+        #Ignores the correlation between the fitted parameters
+        t1_err = np.sqrt(((b / a - 1) * t1_star_err)**2 + (t1_star / a * b_err)**2 + (t1_star * b / a**2 * perr[:, 2])**2)
+
+    fit = np.stack((a, b, t1_star), axis=1)
+    fit_err = np.stack((perr[:, 2], b_err, t1_star_err), axis=1)
+    if np.ndim(y) == 1:
+        return t1[0], t1_err[0], fit[0], fit_err[0]
+    return t1, t1_err, fit, fit_err
+
+@lru_cache(maxsize=16)
+def laplace_kernel(n, tr, t2_min, t2_max, nt2):
+    #exp(-t/T2) for n echoes and nt2 log spaced T2 values, and its SVD truncated to the singular values that
+    #matter at double precision. The decays are compressed onto the kept singular vectors before solving.
+    t2s = np.geomspace(t2_min, t2_max, nt2)
+    kernel = np.exp(-np.outer(np.arange(n) * tr, 1 / t2s))
+    u, s, vt = np.linalg.svd(kernel, full_matrices=False)
+    keep = s > s[0] * 1e-12
+    compressed = s[keep, None] * vt[keep]
+    basis = u[:, keep]
+    for a in (t2s, kernel, compressed, basis):
+        a.flags.writeable = False
+    return t2s, kernel, compressed, basis
+
+def t2_distribution(y, tr, t2_range = None, nt2 = 100, alpha = 1e-2):
+    #T2 distribution of one decay or of each row of a batch, by non-negative least squares with Tikhonov
+    #regularization: minimize |K f - y|^2 + alpha*|f|^2 over f >= 0, with K[i, j] = exp(-i*tr/T2[j]).
+    #alpha is relative to the squared amplitude of the decay, so it does not depend on the signal scale.
+    #t2_range defaults to the echo spacing up to ten times the length of the decay.
+    #Returns the T2 values, the amplitude of each (one row per decay) and the rms residual of each fit.
+    y = np.asarray(y, dtype=float)
+    single = y.ndim == 1
+    y = np.atleast_2d(y)
+    n = y.shape[1]
+    if t2_range is None:
+        t2_range = (tr, 10 * n * tr)
+    import scipy.optimize as opt
+    t2s, kernel, compressed, basis = laplace_kernel(n, float(tr), float(t2_range[0]), float(t2_range[1]), nt2)
+
+    reg = np.sqrt(alpha) * np.eye(nt2)
+    augmented = np.vstack((compressed, reg))
+    rhs = np.zeros(len(augmented))
+    amps = np.zeros((len(y), nt2))
+    for i, decay in enumerate(y):
+        scale = np.max(np.abs(decay))
+        if scale == 0:
+            continue
+        rhs[:len(compressed)] = basis.T @ (decay / scale)
+        amps[i] = opt.nnls(augmented, rhs)[0] * scale
+    residual = np.sqrt(np.mean((y - amps @ kernel.T)**2, axis=1))
+    if single:
+        return t2s, amps[0], residual[0]
+    return t2s, amps, residual
@@ -0,0 +1,149 @@
+import time
+from collections import deque
+
+# Per-shot instrumentation. A sequence marks the end of each of its phases with ShotMetrics.mark(name), which adds
+# the time since the previous mark to that phase, and receive() and the TX helpers count what the radio reported.
+# When SDMRR.metrics is None the sequences use NULL_SHOT, whose methods do nothing.
+
+class ShotMetrics:
+
+    def __init__(self, sequence, collector = None):
+        self.sequence = sequence
+        self.collector = collector
+        self.start = time.time()
+        self.timings = {}           # seconds spent in each phase of the shot
+        self.rx_errors = {}         # count of each RX metadata error code other than none, e.g. overflow, late, timeout
+        self.tx_events = {}         # count of each async TX event, e.g. burst_ack, underflow, time_error
+        self.rx_samples = 0
+        self.rx_expected = 0
+        self.tx_samples = 0
+        self.tx_expected = 0
+        self.out_of_sequence = 0
+        self.scheduled_time = None  # device time the RX stream was asked to start at
+        self.first_sample_time = None
+        self.cancelled = False      # the rest of the shot was cancelled on purpose, e.g. by a stop condition
+        self._last = time.perf_counter()
+
+    def expect(self, scheduled_time, nsamps):
+        #The RX stream of the shot, as it was requested
+        self.scheduled_time = scheduled_time
+        self.rx_expected += nsamps
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.timings[phase] = self.timings.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def add_time(self, phase, seconds):
+        #For phases timed in another thread, e.g. the RX loop
+        self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+    def cancel(self):
+        #Samples missing after this are not an error
+        self.cancelled = True
+
+    def rx(self, metadata, n):
+        #Called by receive() after every recv()
+        code = metadata.error_code.name
+        if code != "none":
+            self.rx_errors[code] = self.rx_errors.get(code, 0) + 1
+        if metadata.out_of_sequence:
+            self.out_of_sequence += 1
+        if n and self.first_sample_time is None and metadata.has_time_spec:
+            self.first_sample_time = metadata.time_spec.get_real_secs()
+        self.rx_samples += n
+
+    def tx(self, sent, expected):
+        self.tx_samples += sent
+        self.tx_expected += expected
+
+    def tx_async(self, tx_streamer, metadata, timeout = 0.0):
+        #Count the async TX messages (burst acks, underflows, late bursts) waiting on the streamer
+        while tx_streamer.recv_async_msg(metadata, timeout):
+            code = metadata.event_code.name
+            self.tx_events[code] = self.tx_events.get(code, 0) + 1
+
+    def start_error(self):
+        #Device time of the first sample received minus the time it was scheduled for
+        if self.first_sample_time is None or self.scheduled_time is None:
+            return None
+        return self.first_sample_time - self.scheduled_time
+
+    def ok(self):
+        #True if the radio reported nothing unusual and every sample was sent and received, or the shot was cancelled
+        return (not self.rx_errors.keys() - {"timeout"} and self.out_of_sequence == 0
+                and not self.tx_events.keys() - {"burst_ack"}
+                and (self.cancelled or (self.rx_samples >= self.rx_expected and self.tx_samples >= self.tx_expected)))
+
+    def finish(self):
+        self.total = time.time() - self.start
+        if self.collector is not None:
+            self.collector.add(self)
+
+    def __repr__(self):
+        timings = ", ".join("%s %.3fms" % (k, 1e3*v) for k, v in self.timings.items())
+        return "<%s %s: %s, rx %d/%d, tx %d/%d, rx errors %s, tx events %s>" % (self.sequence, "ok" if self.ok() else "FAILED",
+            timings, self.rx_samples, self.rx_expected, self.tx_samples, self.tx_expected, self.rx_errors, self.tx_events)
+
+
+class _NullShot:
+    #Stands in for ShotMetrics when instrumentation is off
+
+    def expect(self, scheduled_time, nsamps):
+        pass
+
+    def mark(self, phase):
+        pass
+
+    def add_time(self, phase, seconds):
+        pass
+
+    def cancel(self):
+        pass
+
+    def rx(self, metadata, n):
+        pass
+
+    def tx(self, sent, expected):
+        pass
+
+    def tx_async(self, tx_streamer, metadata, timeout = 0.0):
+        pass
+
+    def finish(self):
+        pass
+
+NULL_SHOT = _NullShot()
+
+
+class Metrics:
+    #Collects the ShotMetrics of the last `keep` shots. callback(shot) is called as each shot finishes, from the
+    #thread that processed it.
+
+    def __init__(self, callback = None, keep = 1000):
+        self.callback = callback
+        self.shots = deque(maxlen=keep)
+
+    def shot(self, sequence):
+        return ShotMetrics(sequence, self)
+
+    def add(self, shot):
+        self.shots.append(shot)
+        if self.callback is not None:
+            self.callback(shot)
+
+    def failures(self):
+        return [shot for shot in self.shots if not shot.ok()]
+
+    def summary(self):
+        #Mean time per phase, and total error counts, over the kept shots
+        timings, rx_errors, tx_events = {}, {}, {}
+        for shot in self.shots:
+            for k, v in shot.timings.items():
+                timings[k] = timings.get(k, 0.0) + v / len(self.shots)
+            for k, v in shot.rx_errors.items():
+                rx_errors[k] = rx_errors.get(k, 0) + v
+            for k, v in shot.tx_events.items():
+                tx_events[k] = tx_events.get(k, 0) + v
+        return {"shots": len(self.shots), "failed": len(self.failures()), "timings": timings,
+                "rx_errors": rx_errors, "tx_events": tx_events}
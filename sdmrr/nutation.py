@@ -0,0 +1,57 @@
+import numpy as np
+
+#Points tried around the current t90 estimate once the nutation curve has been fitted, as multiples of t90.
+#The flanks constrain t90 more than the peak does, where the curve is flat.
+REFINE_STEPS = [1.0, 0.6, 1.4, 0.8, 1.2]
+
+#The search steps up from the shortest pulse by SWEEP_RATIO until the FID amplitude falls below SWEEP_DROP of the best
+#so far, so the first maximum is surrounded by points whatever t90 is. Below 2 no lobe of the curve can be skipped.
+SWEEP_RATIO = 1.4
+SWEEP_DROP = 0.7
+
+def nutation_model(t, a, t90, tau, c):
+    #FID amplitude against pulse length: damped |sin| with its first maximum at t90, on top of a noise floor
+    return a * np.abs(np.sin(np.pi/2 * t/t90)) * np.exp(-t/tau) + c
+
+def fit_nutation(t, scores, t90_range = (5e-6, 100e-6)):
+    #Fit the nutation model to the FID amplitudes measured at pulse lengths t.
+    #Returns the fitted parameters (a, t90, tau, c) and their standard errors, or None if the fit failed or does not
+    #describe the data: a nutation amplitude below the floor, or residuals large next to the amplitude.
+    t = np.asarray(t, dtype=float)
+    scores = np.asarray(scores, dtype=float)
+    if len(t) < 5:
+        return None
+
+    lower = [0, t90_range[0]/2, t90_range[1]/10, 0]
+    upper = [np.inf, 2*t90_range[1], np.inf, np.max(scores)]
+    import scipy.optimize as opt
+
+    #The kink of |sin| at each zero traps the fit, so it is started from a few t90s around the best point and the
+    #closest fit is kept
+    best = None
+    for guess in t[np.argmax(scores)] * np.array([0.8, 1, 1.25]):
+        p0 = [np.max(scores), np.clip(guess, lower[1], upper[1]), 20*t90_range[1], np.min(scores)/2]
+        try:
+            fit = opt.curve_fit(nutation_model, t, scores, p0=p0, bounds=(lower, upper), absolute_sigma=True)
+        except (RuntimeError, ValueError):
+            continue
+        residuals = scores - nutation_model(t, *fit[0])
+        if best is None or np.sum(residuals**2) < np.sum(best[2]**2):
+            best = fit + (residuals,)
+    if best is None:
+        return None
+    popt, pcov, residuals = best
+    rms = np.sqrt(np.sum(residuals**2) / (len(t) - len(popt)))
+    if popt[0] < popt[3] or rms > 0.2 * popt[0]:
+        return None
+    #The scores have no known errors, so the errors are scaled by the scatter of the residuals
+    perr = np.sqrt(np.abs(np.diag(pcov))) * rms
+    if not np.all(np.isfinite(perr)):
+        return None
+    return popt, perr
+
+def next_nutation_point(t90, step, fs, t90_range = (5e-6, 100e-6)):
+    #Pulse length to try next, on the sample grid and inside the calibration range
+    t = t90 * REFINE_STEPS[step % len(REFINE_STEPS)]
+    t = np.clip(t, t90_range[0], 2*t90_range[1])
+    return np.round(t * fs) / fs
@@ -0,0 +1,134 @@
+import multiprocessing as mp
+import os
+import pickle
+from concurrent.futures import Future
+from threading import Lock, Thread
+
+# Runs several consoles in parallel, each in its own worker process with its own radio and calibration file.
+# The worker processes are started with "spawn", so nothing from the coordinator (streamers, threads, the uhd
+# module) is shared with them. A backend other than uhd is given as a picklable function returning it, e.g.
+# functools.partial(sdmrr.SimulatedUHD, sdmrr.SpinModel(f0=22.1e6)), and called once in each worker.
+
+def _portable(error):
+    #Exceptions are sent back to the coordinator, which needs to be able to unpickle them
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return RuntimeError(repr(error))
+
+def _console_worker(conn, nocal, backend, args, cal_path):
+    from sdmrr.SDMRR import SDMRR
+
+    try:
+        console = SDMRR(nocal=nocal, backend=None if backend is None else backend(), args=args, cal_path=cal_path)
+        failure = None
+    except Exception as e:
+        console = None
+        failure = _portable(e)
+
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        job_id, name, kwargs = job
+        if failure is not None:
+            conn.send((job_id, False, failure))
+            continue
+        try:
+            attr = getattr(console, name)
+            result = attr(**kwargs) if callable(attr) else attr
+            conn.send((job_id, True, result))
+        except Exception as e:
+            conn.send((job_id, False, _portable(e)))
+
+    if console is not None:
+        console.stop_recording()
+    conn.close()
+
+
+class Rack:
+    #Coordinator for a set of consoles. consoles is a list of dicts of SDMRR constructor arguments (args, cal_path
+    #and optionally nocal). Every console needs its own cal_path, so they never overwrite each other's calibration.
+    #Jobs are SDMRR method names with keyword arguments, and each console runs its jobs in order while the consoles
+    #run in parallel. Naming an attribute instead of a method returns its value.
+
+    def __init__(self, consoles, backend = None, nocal = False):
+        paths = [spec.get("cal_path") for spec in consoles]
+        if None in paths:
+            raise ValueError("every console needs a cal_path")
+        if len(set(os.path.abspath(p) for p in paths)) < len(paths):
+            raise ValueError("consoles share a cal_path")
+
+        ctx = mp.get_context("spawn")
+        self._workers = []
+        for spec in consoles:
+            parent, child = ctx.Pipe()
+            process = ctx.Process(target=_console_worker, daemon=True,
+                                  args=(child, spec.get("nocal", nocal), backend, spec.get("args", "type=b200"), spec["cal_path"]))
+            process.start()
+            child.close()
+            worker = {"process": process, "conn": parent, "lock": Lock(), "futures": {}, "next": 0}
+            worker["listener"] = Thread(target=self._listen, args=(worker,), daemon=True)
+            worker["listener"].start()
+            self._workers.append(worker)
+
+    def __len__(self):
+        return len(self._workers)
+
+    def submit(self, console, name, **kwargs):
+        #Queue a job on one console, and return a Future for its result
+        worker = self._workers[console]
+        future = Future()
+        with worker["lock"]:
+            job_id = worker["next"]
+            worker["next"] += 1
+            worker["futures"][job_id] = future
+            worker["conn"].send((job_id, name, kwargs))
+        return future
+
+    def run(self, name, per_console = None, **kwargs):
+        #Run the same job on every console at once and gather the results, in console order. per_console is an
+        #optional list with extra keyword arguments for each console, e.g. a different number of echoes per sample.
+        futures = []
+        for i in range(len(self)):
+            extra = per_console[i] if per_console is not None else {}
+            futures.append(self.submit(i, name, **dict(kwargs, **extra)))
+        return [f.result() for f in futures]
+
+    def close(self):
+        for worker in self._workers:
+            with worker["lock"]:
+                try:
+                    worker["conn"].send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+        for worker in self._workers:
+            worker["process"].join()
+            worker["listener"].join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _listen(self, worker):
+        #Resolve the futures of one console as its results come back
+        while True:
+            try:
+                job_id, ok, result = worker["conn"].recv()
+            except (EOFError, OSError):
+                break
+            with worker["lock"]:
+                future = worker["futures"].pop(job_id)
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+        #The worker is gone, fail whatever it did not finish
+        with worker["lock"]:
+            futures, worker["futures"] = worker["futures"], {}
+        for future in futures.values():
+            future.set_exception(RuntimeError("console worker exited"))
@@ -0,0 +1,167 @@
+import numpy as np
+from sdmrr.dsp import decimation_taps, demodulate, lowpass, lowpass_sos
+
+class BufferPool:
+    #Reusable receive buffers. Each name keeps one buffer that is only reallocated when a longer one is requested.
+
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, n, name = "rx"):
+        buff = self._buffers.get(name)
+        if buff is None or buff.shape[1] < n:
+            buff = np.empty((1, n), dtype=np.complex64)
+            self._buffers[name] = buff
+        return buff[:, :n]
+
+    def clear(self):
+        self._buffers = {}
+
+
+def receive(rx_streamer, buff, metadata, on_chunk = None, nsamps = None, stats = None):
+    #Receive samples straight into buff, without intermediate copies, until the stream ends or nsamps samples
+    #have been received. recv() will return zeros, then our samples, then more zeros, letting us know it's done.
+    #on_chunk(start, chunk) is called from the receiving thread with a view of each chunk as it lands.
+    #If nsamps is longer than buff, buff is reused as a ring and on_chunk has to consume the samples.
+    #stats.rx(metadata, n) is called after every recv(), e.g. with a ShotMetrics to count errors.
+    size = buff.shape[-1]
+    total = size if nsamps is None else nsamps
+    waiting_to_start = True # keep track of where we are in the cycle (see above comment)
+    n = 0
+    i = 0
+    while i < total and (n != 0 or waiting_to_start):
+        j = i % size
+        n = rx_streamer.recv(buff[..., j:j + min(size - j, total - i)], metadata)
+        if stats is not None:
+            stats.rx(metadata, n)
+        if n and waiting_to_start:
+            waiting_to_start = False
+        if n and on_chunk is not None:
+            on_chunk(i, buff[..., j:j+n])
+        i += n
+
+    #Don't leave samples from a previous shot in the buffer if the stream ended early
+    if i < size and total <= size:
+        buff[..., i:] = 0
+    return i
+
+
+class EchoGate:
+    #Keeps only fixed-width windows of a stream as it arrives. Each chunk is demodulated by `shift` and lowpass
+    #filtered (Butterworth, `order`, `cutoff`), carrying the filter state between chunks, so the windows match the
+    #ones cut from the filtered full trace. With integrate=True only the sum over each window is kept.
+    #on_window(k) is called from the receiving thread as each window is completed, in order.
+
+    def __init__(self, starts, width, fs, shift, order, cutoff, integrate = False, head = 80, on_window = None):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.width = int(width)
+        self.fs = fs
+        self.shift = shift
+        self.integrate = integrate
+        self.windows = None if integrate else np.zeros((len(self.starts), self.width), dtype=np.complex64)
+        self.sums = np.zeros(len(self.starts), dtype=np.complex128)
+        self.head = np.zeros(head, dtype=np.complex64)   # start of the trace, used to find the phase
+        self.order = order
+        self.cutoff = cutoff
+        lowpass_sos(order, cutoff, fs) #Design the filter (and import scipy) now rather than in the receiving thread
+        self._zi = None
+        self._scratch = None
+        self.on_window = on_window
+        self.done = 0   # number of completed windows
+
+    def __call__(self, start, chunk):
+        n = chunk.shape[-1]
+        if self._scratch is None or len(self._scratch) < n:
+            self._scratch = np.empty(n, dtype=np.complex64)
+        y = demodulate(chunk.reshape(-1), self.shift, self.fs, start=start, out=self._scratch[:n])
+        _, self._zi = lowpass(y, self.order, self.cutoff, self.fs, out=y, zi=self._zi)
+        end = start + n
+
+        if start < len(self.head):
+            h = min(end, len(self.head))
+            self.head[start:h] = y[:h - start]
+
+        first = np.searchsorted(self.starts + self.width, start, side='right')
+        last = np.searchsorted(self.starts, end, side='left')
+        for k in range(first, last):
+            w0 = max(self.starts[k], start)
+            w1 = min(self.starts[k] + self.width, end)
+            if self.integrate:
+                self.sums[k] += np.sum(y[w0 - start:w1 - start])
+            else:
+                self.windows[k, w0 - self.starts[k]:w1 - self.starts[k]] = y[w0 - start:w1 - start]
+
+        done = np.searchsorted(self.starts + self.width, end, side='right')
+        while self.done < done:
+            self.done += 1
+            if self.on_window is not None:
+                self.on_window(self.done - 1)
+
+    def result(self, phase = 0):
+        if self.integrate:
+            return self.sums * np.exp(1j*phase)
+        return self.windows * np.complex64(np.exp(1j*phase))
+
+
+class Decimator:
+    #Demodulates each chunk of a stream by `shift`, lowpass filters it and keeps every factor-th sample, as the
+    #chunks arrive. The FIR is applied in polyphase form on blocks of factor samples, so only the kept samples are
+    #computed, and the input still needed by the filter is carried between chunks. Like the lowpass, the filter
+    #starts in steady state for the first sample. The output rate is fs/factor, with factor the nearest integer
+    #to fs/rate, and cutoff defaults to 0.4 of it.
+    #Output samples go to `out` (nsamps//factor long, allocated if None) and, if given, to on_chunk(start, chunk)
+    #with positions in output samples, e.g. a RecordWriter. Output sample k lines up with input sample
+    #factor*(k - delay): delay is the group delay of the filter in output samples, use index() to convert.
+
+    def __init__(self, nsamps, fs, rate, shift, cutoff = None, taps_per_phase = 16, out = None, on_chunk = None):
+        self.factor = max(1, int(round(fs / rate)))
+        self.fs = fs
+        self.rate = fs / self.factor
+        self.shift = shift
+        self.cutoff = 0.4 * self.rate if cutoff is None else cutoff
+        self.nsamps = nsamps // self.factor
+        self.out = np.empty(self.nsamps, dtype=np.complex64) if out is None else out
+        self.on_chunk = on_chunk
+        self.delay = ((taps_per_phase * self.factor - 1) / 2 - (self.factor - 1)) / self.factor
+        self.count = 0      # output samples produced
+        self._phases = decimation_taps(self.factor, self.cutoff, fs, taps_per_phase)
+        self._history = (taps_per_phase - 1) * self.factor
+        self._held = None   # input samples carried over, at the start of _x
+        self._x = np.empty(0, dtype=np.complex64)
+
+    def index(self, n):
+        #Output sample matching input sample n
+        return int(round(n / self.factor + self.delay))
+
+    def __call__(self, start, chunk):
+        n = chunk.shape[-1]
+        M, L = self.factor, len(self._phases)
+        held = 0 if self._held is None else self._held
+        if len(self._x) < self._history + M + n:
+            x = np.empty(self._history + M + n, dtype=np.complex64)
+            x[:held] = self._x[:held]
+            self._x = x
+        x = self._x
+        if self._held is None:
+            demodulate(chunk.reshape(-1), self.shift, self.fs, start=start, out=x[self._history:self._history + n])
+            x[:self._history] = x[self._history] if n else 0
+            held = self._history
+        else:
+            demodulate(chunk.reshape(-1), self.shift, self.fs, start=start, out=x[held:held + n])
+        total = held + n
+
+        nblocks = total // M - (L - 1)
+        if nblocks > 0:
+            blocks = x[:(nblocks + L - 1) * M].reshape(-1, M)
+            y = blocks[L - 1:] @ self._phases[0]
+            for l in range(1, L):
+                y += blocks[L - 1 - l:L - 1 - l + nblocks] @ self._phases[l]
+            k = self.count
+            m = min(nblocks, max(0, self.nsamps - k))
+            self.out[k:k + m] = y[:m]
+            if m and self.on_chunk is not None:
+                self.on_chunk(k, y[:m])
+            self.count += nblocks
+            x[:total - nblocks * M] = x[nblocks * M:total]
+            total -= nblocks * M
+        self._held = total
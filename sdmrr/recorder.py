@@ -0,0 +1,186 @@
+import numpy as np
+import json
+import os
+import time
+from threading import Lock
+
+# Raw data recorder. A recording is a directory holding
+#   header.json     metadata for the whole session, written once when the recording is created
+#   index.jsonl     one line per finished record: name, chunk file, byte offset, shape, dtype, parameters, timestamps
+#   chunkNNNNN.bin  raw samples, filled through np.memmap and trimmed to their used length when closed
+# Records are only ever appended, and a record is listed in the index once all its samples are written, so a
+# crash loses at most the shot in progress. Each record is contiguous in one chunk file, so it can be read back
+# as a memmap view without copying.
+
+CHUNK_BYTES = 1 << 28   # Default size of a chunk file, records larger than this get a chunk of their own
+ALIGN = 64              # Byte alignment of records in the chunk files
+
+def _jsonable(x):
+    if isinstance(x, np.generic):
+        return x.item()
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    if isinstance(x, complex):
+        return [x.real, x.imag]
+    return str(x)
+
+
+class RecordWriter:
+    #A record being written. Can be passed as the on_chunk callback of receive(), which calls it with the
+    #position and a view of every chunk as it lands, or filled with write().
+
+    def __init__(self, recorder, entry, data):
+        self.recorder = recorder
+        self.entry = entry
+        self.data = data        # memmap view of the record in its chunk file
+        self.count = 0          # samples written along the last axis
+
+    def __call__(self, start, chunk):
+        self.write(chunk, start)
+
+    def write(self, data, start = 0):
+        data = np.asarray(data)
+        if self.data.ndim == 1:
+            data = data.reshape(-1)
+        n = data.shape[-1]
+        self.data[..., start:start + n] = data
+        self.count = max(self.count, start + n)
+
+    def end(self, **params):
+        #Finish the record, adding any parameters only known after the shot
+        self.entry["params"].update(params)
+        self.entry["end"] = time.time()
+        self.recorder._finish(self)
+
+
+class Recorder:
+    #Append-only recording of shots to disk. meta is stored in header.json. Opening an existing recording
+    #appends to it, starting a new chunk file.
+
+    def __init__(self, path, chunk_bytes = CHUNK_BYTES, **meta):
+        self.path = path
+        self.chunk_bytes = chunk_bytes
+        self._lock = Lock()
+        self._map = None
+        self._used = 0
+        self._nrecords = 0
+
+        os.makedirs(path, exist_ok=True)
+        header = os.path.join(path, "header.json")
+        if os.path.isfile(header):
+            with open(header, "r") as f:
+                self.meta = json.load(f)
+            self._chunk = len([f for f in os.listdir(path) if f.startswith("chunk")]) - 1
+        else:
+            self.meta = dict(meta, created=time.time(), version=1)
+            with open(header + ".tmp", "w") as f:
+                json.dump(self.meta, f, indent=4, default=_jsonable)
+            os.replace(header + ".tmp", header)
+            self._chunk = -1
+        index = os.path.join(path, "index.jsonl")
+        if os.path.isfile(index):
+            with open(index, "rb+") as f:
+                lines = f.read()
+                #Drop a last line that was interrupted while it was written, so the next one starts on its own line
+                f.truncate(lines.rfind(b"\n") + 1)
+            self._nrecords = lines.count(b"\n")
+        self._index = open(index, "a")
+
+    def begin(self, name, shape, dtype = np.complex64, caldict = None, **params):
+        #Reserve space for a record and return its writer
+        shape = tuple(np.atleast_1d(shape).tolist())
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        with self._lock:
+            offset = -(-self._used // ALIGN) * ALIGN
+            if self._map is None or offset + nbytes > len(self._map):
+                self._new_chunk(nbytes)
+                offset = 0
+            self._used = offset + nbytes
+            data = self._map[offset:offset + nbytes].view(dtype).reshape(shape)
+            entry = {"name": name, "file": self._filename(self._chunk), "offset": offset, "shape": list(shape),
+                     "dtype": dtype.str, "params": params, "caldict": dict(caldict) if caldict is not None else None,
+                     "start": time.time()}
+        return RecordWriter(self, entry, data)
+
+    def save(self, name, data, caldict = None, **params):
+        #Record an array that is already in memory, e.g. gated echo windows
+        data = np.asarray(data)
+        record = self.begin(name, data.shape, data.dtype, caldict, **params)
+        record.write(data)
+        record.end()
+
+    def close(self):
+        with self._lock:
+            self._close_chunk()
+            self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self._nrecords
+
+    def _filename(self, chunk):
+        return "chunk%05d.bin" % chunk
+
+    def _new_chunk(self, nbytes):
+        self._close_chunk()
+        self._chunk += 1
+        size = max(self.chunk_bytes, nbytes, 1)
+        #The file is sparse until written, so the unused end of a chunk takes no space
+        self._map = np.memmap(os.path.join(self.path, self._filename(self._chunk)), dtype=np.uint8, mode="w+", shape=(size,))
+        self._used = 0
+
+    def _close_chunk(self):
+        if self._map is not None:
+            self._map.flush()
+            self._map = None
+            os.truncate(os.path.join(self.path, self._filename(self._chunk)), self._used)
+
+    def _finish(self, record):
+        with self._lock:
+            if self._map is not None and record.entry["file"] == self._filename(self._chunk):
+                self._map.flush()
+            self._index.write(json.dumps(record.entry, default=_jsonable) + "\n")
+            self._index.flush()
+            self._nrecords += 1
+
+
+class Recording:
+    #Read access to a recording. Records are returned as read-only memmap views of the chunk files.
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "header.json"), "r") as f:
+            self.meta = json.load(f)
+        self.records = []
+        with open(os.path.join(path, "index.jsonl"), "r") as f:
+            for line in f:
+                try:
+                    self.records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break   # last line of a recording that was interrupted while writing it
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        entry = self.records[i]
+        if entry["file"] not in self._maps:
+            self._maps[entry["file"]] = np.memmap(os.path.join(self.path, entry["file"]), dtype=np.uint8, mode="r")
+        dtype = np.dtype(entry["dtype"])
+        nbytes = int(np.prod(entry["shape"])) * dtype.itemsize
+        return self._maps[entry["file"]][entry["offset"]:entry["offset"] + nbytes].view(dtype).reshape(entry["shape"])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def select(self, name):
+        #Indices of the records of one sequence
+        return [i for i, entry in enumerate(self.records) if entry["name"] == name]
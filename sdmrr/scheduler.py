@@ -0,0 +1,49 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class ShotScheduler:
+    #Runs shots back to back, starting each one repetition_time seconds after the previous one ended, and
+    #processes finished shots in a worker thread while the sample recovers.
+    #acquire(slot) runs a shot and returns a function that processes it. Shots that are still being processed keep
+    #their slot, so with `slots` receive buffers a shot never overwrites data that has not been processed yet.
+
+    def __init__(self, repetition_time, slots = 2, last_end = None):
+        self.repetition_time = repetition_time
+        self.slots = slots
+        self.last_end = last_end    # time.monotonic() at the end of the previous shot
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = [None] * slots
+        self._count = 0
+
+    def wait(self):
+        if self.last_end is not None:
+            delay = self.last_end + self.repetition_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def run(self, shot):
+        #Run a shot in this thread once the recovery time has passed, and return its result
+        self.wait()
+        result = shot()
+        self.last_end = time.monotonic()
+        return result
+
+    def submit(self, acquire):
+        slot = self._count % self.slots
+        if self._futures[slot] is not None:
+            self._futures[slot].result()
+        self.wait()
+        process = acquire(slot)
+        self.last_end = time.monotonic()
+        self._futures[slot] = self._executor.submit(process)
+        self._count += 1
+        return self._futures[slot]
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
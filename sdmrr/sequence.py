@@ -0,0 +1,202 @@
+import numpy as np
+import time
+from functools import lru_cache
+from sdmrr.waveforms import pulse_waveform
+from sdmrr.metrics import NULL_SHOT
+
+# Declarative pulse sequences. A Sequence lists pulses, T/R switch (GPIO) commands and the acquisition window
+# against device time, and compile() turns it into what the radio needs:
+#   - as few TX bursts as possible. Pulses closer than max_gap are joined into one contiguous burst, with the
+#     zeros between them filled in once, so there is no per-pulse send() and no burst start to arrive late.
+#   - the GPIO commands in time order, without the ones that would not change the outputs.
+# CompiledSequence.start_rx() issues the stream command of the acquisition window, and play() then streams each
+# burst in chunks cut between pulses, and issues each GPIO command just before the chunk that plays at its time.
+# Both are paced against the device clock, so the host never has more than a chunk, or a fixed lead, queued ahead.
+
+class Sequence:
+
+    def __init__(self, fs, tune_shift, zbuff_time = 40e-6):
+        self.fs = fs
+        self.tune_shift = tune_shift
+        self.zbuff_time = zbuff_time  # zeros sent before the first pulse of each burst, for a clean startup
+        self.pulses = []    # (start time, duration, amplitude, phase in quadrants)
+        self.gpio = []      # (time, value, mask)
+        self.rx = None      # (start time, number of samples)
+
+    def pulse(self, time, duration, amp = 1, phase = 0):
+        self.pulses.append((time, duration, amp, phase))
+        return self
+
+    def gate(self, time, value, mask = 0xFFF):
+        #Set the GPIO outputs in mask to value at time
+        self.gpio.append((time, value, mask))
+        return self
+
+    def acquire(self, time, nsamps):
+        self.rx = (time, int(nsamps))
+        return self
+
+    def compile(self, max_gap = 10e-3, initial_gpio = None):
+        #initial_gpio is the GPIO output value before the sequence starts, if known, so the first commands can be
+        #dropped too when they do not change anything
+        fs = self.fs
+        pulses = sorted(self.pulses)
+        bursts = []
+        group = []
+        for p in pulses:
+            if group and p[0] - (group[-1][0] + group[-1][1]) > max_gap:
+                bursts.append(self._burst(group))
+                group = []
+            group.append(p)
+        if group:
+            bursts.append(self._burst(group))
+
+        gpio = []
+        state = initial_gpio
+        for t, value, mask in sorted(self.gpio, key=lambda g: g[0]):
+            if state is not None and (state & mask) == (value & mask):
+                continue
+            gpio.append((t, value, mask))
+            state = ((state or 0) & ~mask) | (value & mask)
+        return CompiledSequence(bursts, gpio, self.rx, fs)
+
+    def _burst(self, group):
+        #One contiguous burst for a group of pulses, and the sample ranges of its pulses
+        fs = self.fs
+        start = group[0][0] - self.zbuff_time
+        waveforms = [pulse_waveform(d, a, ph, fs, self.tune_shift, 0) for t, d, a, ph in group]
+        offsets = [int(round((t - start) * fs)) for t, d, a, ph in group]
+        samples = np.zeros(max(o + len(w) for o, w in zip(offsets, waveforms)), dtype=np.complex64)
+        ranges = []
+        for o, w in zip(offsets, waveforms):
+            samples[o:o + len(w)] = w
+            ranges.append((o, o + len(w)))
+        samples.flags.writeable = False
+        return start, samples, ranges
+
+
+class CompiledSequence:
+
+    def __init__(self, bursts, gpio, rx, fs):
+        self.bursts = bursts    # (device start time, samples, pulse sample ranges)
+        self.gpio = gpio        # (device time, value, mask), in time order
+        self.rx = rx            # (device start time, number of samples) or None
+        self.fs = fs
+
+    def cuts(self, chunk):
+        #Where each burst is split into sends of about chunk samples, always between pulses
+        cuts = []
+        for start, samples, ranges in self.bursts:
+            points = [0]
+            for (s0, e0), (s1, e1) in zip(ranges[:-1], ranges[1:]):
+                if s1 - points[-1] > chunk:
+                    points.append(e0)
+            points.append(len(samples))
+            cuts.append(points)
+        return cuts
+
+    def start_rx(self, rx_streamer, lib, shot = NULL_SHOT):
+        #Ask for the acquisition window, a timed stream of a fixed number of samples. Returns that number.
+        start, nsamps = self.rx
+        stream_cmd = lib.types.stream_cmd(lib.types.stream_mode.num_done)
+        stream_cmd.num_samps = nsamps
+        stream_cmd.stream_now = False
+        stream_cmd.time_spec = lib.types.time_spec(start)
+        rx_streamer.issue_stream_cmd(stream_cmd)
+        shot.expect(start, nsamps)
+        return nsamps
+
+    def stop_rx(self, rx_streamer, lib):
+        #End the acquisition early
+        rx_streamer.issue_stream_cmd(lib.types.stream_cmd(lib.types.stream_mode.stop_cont))
+
+    def play(self, radio, tx_streamer, lib, shot = NULL_SHOT, chunk = 32768, bank = "FP0", stop = None, lead = 20e-3):
+        #Stream the bursts and queue the GPIO commands. Returns the device time at which the samples sent so far
+        #have played out. Once the stop event (a threading.Event) is set, the burst being sent is ended at its next
+        #cut and nothing more is sent or scheduled.
+        #Nothing is sent or queued more than lead seconds ahead of the device time, as the radio only holds a few
+        #timed commands, and sends of short bursts return at once.
+        gpio = list(self.gpio)
+        end = 0.0
+        clock = [radio.get_time_now().get_real_secs(), time.monotonic()]
+
+        def _wait(t):
+            #Sleep until the device time is within lead of t. The device clock is only read again when there is
+            #something to wait for, in between it is followed with the host clock.
+            while t - lead > clock[0] + time.monotonic() - clock[1]:
+                time.sleep(t - lead - (clock[0] + time.monotonic() - clock[1]))
+                clock[:] = [radio.get_time_now().get_real_secs(), time.monotonic()]
+
+        def _gpio_until(t, before = np.inf):
+            #Issue the commands before t, each one once the device time is within lead of it or of before
+            while gpio and gpio[0][0] < t:
+                gt, value, mask = gpio.pop(0)
+                _wait(min(gt, before))
+                radio.set_command_time(lib.types.time_spec(gt))
+                radio.set_gpio_attr(bank, "OUT", value, mask)
+            radio.clear_command_time()
+            shot.mark("gpio")
+
+        for (start, samples, ranges), points in zip(self.bursts, self.cuts(chunk)):
+            for k, (i0, i1) in enumerate(zip(points[:-1], points[1:])):
+                _gpio_until(start + i0 / self.fs)
+                _wait(start + i0 / self.fs)
+                if stop is not None and stop.is_set():
+                    if k > 0:
+                        metadata = lib.types.tx_metadata()
+                        metadata.end_of_burst = True
+                        tx_streamer.send(np.zeros(0, dtype=np.complex64), metadata)
+                    return end
+                #The commands during the chunk go out with it, as its send() may block until most of it has played
+                _gpio_until(start + i1 / self.fs, start + i0 / self.fs)
+                metadata = lib.types.tx_metadata()
+                metadata.start_of_burst = k == 0
+                metadata.end_of_burst = i1 == len(samples)
+                metadata.has_time_spec = k == 0
+                if k == 0:
+                    metadata.time_spec = lib.types.time_spec(start)
+                n = tx_streamer.send(samples[i0:i1], metadata)
+                shot.tx(n, i1 - i0)
+                shot.mark("tx_send")
+                end = start + i1 / self.fs
+        _gpio_until(np.inf)
+        return end
+
+
+@lru_cache(maxsize=8)
+def echo_train(start, t90, amp90, p90p, t180, amp180, phases, tr, fs, tune_shift, zbuff_time, dead_time, gate_each = True):
+    #90 degree pulse at start, then one refocusing pulse every tr, the first at start + tr/2, with the phases in
+    #quadrants cycled. The T/R switch (GPIO pin 1, pin 2 held on) is turned on shortly before each pulse and off
+    #dead_time after it, or with gate_each=False only pin 2 is turned off before the 90 degree pulse. The
+    #acquisition runs from start to tr after the last echo. Compiled sequences are cached, with read-only sample buffers.
+    seq = Sequence(fs, tune_shift, zbuff_time)
+    seq.acquire(start, int(((len(phases) + 1) * tr + t90) * fs))
+    seq.pulse(start, t90, amp90, p90p)
+    for i, phase in enumerate(phases):
+        seq.pulse(start + tr*i + tr/2, t180, amp180, phase)
+
+    if gate_each:
+        for t, d, a, ph in seq.pulses:
+            seq.gate(t - 5e-6, 0x003)
+            seq.gate(t + dead_time + d, 0x002)
+    else:
+        seq.gate(start - 2e-6, 0x000)
+    return seq.compile(initial_gpio=0x002)
+
+
+@lru_cache(maxsize=2)
+def look_locker_train(start, t180, amp180, t90, amp, times, phases, fs, tune_shift, zbuff_time, dead_time, rx):
+    #Inversion pulse centred on start, then one t90 long readout pulse of amplitude amp centred on start + each of
+    #times, with its phase in quadrants. The T/R switch is turned on shortly before each pulse and off dead_time
+    #after it, and rx is the acquisition window (start time, number of samples). The readout pulses are far apart,
+    #so each one gets its own burst instead of a train of zeros.
+    seq = Sequence(fs, tune_shift, zbuff_time)
+    seq.acquire(*rx)
+    if t180 > 0:
+        seq.pulse(start - t180/2, t180, amp180)
+    for t, phase in zip(times, phases):
+        seq.pulse(start + t - t90/2, t90, amp, phase)
+    for t, d, a, ph in seq.pulses:
+        seq.gate(t - 5e-6, 0x003)
+        seq.gate(t + dead_time + d, 0x002)
+    return seq.compile(max_gap=0, initial_gpio=0x002)
@@ -0,0 +1,332 @@
+import asyncio
+import builtins
+import json
+import os
+import socket
+import struct
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock, Thread
+import numpy as np
+
+# Local experiment server. One process owns the SDMRR instance, so the radio stays open and tuned between jobs,
+# and clients (notebooks, scripts, pipelines) send it jobs over a Unix socket or localhost TCP. Jobs are SDMRR
+# sequence and analysis method names with keyword arguments, like in Rack, and run one at a time from a priority
+# queue. Anything else (recording to a path, the radio itself) is not reachable, as any local user can connect.
+# When no job has arrived for `idle` seconds, the server runs check_cal(), so calibrations happen between jobs
+# instead of in them.
+#
+# Every message is a frame: two big-endian uint32 lengths, a JSON header and the raw bytes of the arrays it
+# references. Arrays are replaced in the JSON by {"__array__": index, "dtype": ..., "shape": ...}, and each one
+# starts on a 16 byte boundary of the payload.
+
+ALIGN = 16
+
+SEQUENCES = ("onepulse", "pulseecho", "ncpmg", "cpmg_phaseloop", "look_locker")
+JOBS = SEQUENCES + ("average", "find_f0", "find_t90", "cal", "check_cal", "get_t2", "caldict")
+
+def _encode(obj, arrays):
+    #JSON-able version of obj, with its arrays moved to `arrays`
+    if isinstance(obj, np.ndarray):
+        arrays.append(np.ascontiguousarray(obj))
+        return {"__array__": len(arrays) - 1, "dtype": obj.dtype.str, "shape": list(obj.shape)}
+    if isinstance(obj, np.generic):
+        obj = obj.item()
+    if isinstance(obj, complex):
+        return {"__complex__": [obj.real, obj.imag]}
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if isinstance(obj, dict):
+        return {str(k): _encode(v, arrays) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_encode(v, arrays) for v in obj]
+    if hasattr(obj, "__dict__"):
+        #e.g. a RunningAverage, sent as its public attributes
+        return _encode({k: v for k, v in vars(obj).items() if not k.startswith("_")}, arrays)
+    return repr(obj)
+
+def _decode(obj, payload, offsets):
+    if isinstance(obj, dict):
+        if "__array__" in obj:
+            dtype = np.dtype(obj["dtype"])
+            count = int(np.prod(obj["shape"]))
+            return np.frombuffer(payload, dtype, count, offsets[obj["__array__"]]).reshape(obj["shape"])
+        if "__complex__" in obj:
+            return complex(*obj["__complex__"])
+        return {k: _decode(v, payload, offsets) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_decode(v, payload, offsets) for v in obj]
+    return obj
+
+def pack(header, body):
+    #Frame header (a dict) with body encoded into it. Returns the pieces to send, the arrays are not copied.
+    arrays = []
+    header = dict(header, body=_encode(body, arrays))
+    pieces = [b""]
+    offsets = []
+    size = 0
+    for a in arrays:
+        pad = -size % ALIGN
+        if pad:
+            pieces.append(bytes(pad))
+        offsets.append(size + pad)
+        pieces.append(memoryview(a.reshape(-1).view(np.uint8)))
+        size += pad + a.nbytes
+    header["offsets"] = offsets
+    text = json.dumps(header).encode()
+    pieces[0] = struct.pack("!II", len(text), size) + text
+    return pieces
+
+def unpack(text, payload):
+    #Header of a frame, with its body decoded. The arrays are views of payload, which should be a bytearray.
+    header = json.loads(text)
+    header["body"] = _decode(header["body"], payload, header.pop("offsets"))
+    return header
+
+def _check(request):
+    #Raise ValueError if a request frame is not a job
+    if not isinstance(request.get("id"), int) or isinstance(request["id"], bool):
+        raise ValueError("request without an integer id")
+    if not isinstance(request.get("name"), str):
+        raise ValueError("request without a job name")
+    if not isinstance(request.get("body"), dict):
+        raise ValueError("job arguments are not a dict")
+    priority = request.setdefault("priority", 0)
+    if not isinstance(priority, (int, float)) or isinstance(priority, bool):
+        raise ValueError("priority is not a number")
+
+def _error(header):
+    #The exception a failed job raised, as a builtin type if it was one
+    kind = getattr(builtins, header.get("type", ""), None)
+    if not (isinstance(kind, type) and issubclass(kind, Exception)):
+        kind = RuntimeError
+    return kind(header["error"])
+
+
+class Server:
+    #Serves one console. console is an SDMRR, or None to create one with the keyword arguments (it is created with
+    #nocal=True, calibration is left to the idle gaps). With path, listens on that Unix socket, otherwise on
+    #host:port. Jobs with a lower priority number run first, and jobs of equal priority in the order they came.
+    #Only the names in jobs can be run, and average() only repeats one of SEQUENCES.
+
+    def __init__(self, console = None, path = None, host = "127.0.0.1", port = 5960, idle = 10.0, calibrate = True, jobs = JOBS, **kwargs):
+        if console is None:
+            from sdmrr.SDMRR import SDMRR
+            console = SDMRR(nocal=True, **kwargs)
+        self.console = console
+        self.path = path
+        self.host = host
+        self.port = port
+        self.idle = idle
+        self.calibrate = calibrate
+        self.allowed = frozenset(jobs)
+        self.jobs = 0           # jobs run so far
+        self._executor = ThreadPoolExecutor(max_workers=1)  # the only thread that touches the radio
+        self._loop = None
+        self._stop = None
+        self._started = Future()
+
+    def serve_forever(self):
+        #Run the server in this thread until stop() is called
+        asyncio.run(self._main())
+
+    def start(self):
+        #Run the server in a background thread, and return once it is listening
+        Thread(target=self.serve_forever, daemon=True).start()
+        self._started.result()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._queue = asyncio.PriorityQueue()
+        self._count = 0
+        try:
+            if self.path is not None:
+                if os.path.exists(self.path):
+                    os.unlink(self.path)
+                server = await asyncio.start_unix_server(self._handle, self.path)
+            else:
+                server = await asyncio.start_server(self._handle, self.host, self.port)
+                self.port = server.sockets[0].getsockname()[1]
+        except Exception as e:
+            self._started.set_exception(e)
+            raise
+        worker = asyncio.ensure_future(self._worker())
+        self._started.set_result(True)
+        async with server:
+            await self._stop.wait()
+        worker.cancel()
+        self._executor.shutdown(wait=True)
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def _handle(self, reader, writer):
+        #Queue the jobs of one client as they come in. A frame that is not a valid job is answered with an error.
+        try:
+            while True:
+                text_len, payload_len = struct.unpack("!II", await reader.readexactly(8))
+                text = await reader.readexactly(text_len)
+                payload = bytearray(await reader.readexactly(payload_len))
+                request = None
+                try:
+                    request = unpack(text, payload)
+                    _check(request)
+                except Exception as e:
+                    job_id = request.get("id") if isinstance(request, dict) else None
+                    writer.writelines(pack({"id": job_id, "ok": False, "type": "ValueError", "error": "bad request: %s" % e}, None))
+                    await writer.drain()
+                    continue
+                self._count += 1
+                await self._queue.put((request["priority"], self._count, writer, request))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _worker(self):
+        while True:
+            try:
+                priority, _, writer, request = await asyncio.wait_for(self._queue.get(), self.idle)
+            except asyncio.TimeoutError:
+                await self._idle()
+                continue
+            try:
+                await self._serve(writer, request)
+            except Exception as e:
+                #Never let one job stop the queue
+                print("Job %r failed to run: %r" % (request.get("name"), e))
+
+    async def _serve(self, writer, request):
+        if writer.is_closing():
+            return      #the client is gone, nobody wants the result
+        header = {"id": request["id"]}
+        try:
+            result = await self._loop.run_in_executor(self._executor, self._run, request["name"], request["body"])
+            pieces = pack(dict(header, ok=True), result)
+        except Exception as e:
+            pieces = pack(dict(header, ok=False, type=type(e).__name__, error=str(e)), None)
+        self.jobs += 1
+        try:
+            writer.writelines(pieces)
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    def _run(self, name, kwargs):
+        if name not in self.allowed:
+            raise AttributeError("%s is not a job this server runs" % name)
+        if name == "average" and kwargs.get("sequence", "onepulse") not in SEQUENCES:
+            raise AttributeError("average can only repeat one of %s" % ", ".join(SEQUENCES))
+        attr = getattr(self.console, name)
+        return attr(**kwargs) if callable(attr) else attr
+
+    async def _idle(self):
+        #Nothing to do, refresh the calibration if it is due
+        if not self.calibrate or "lastcal" not in self.console.caldict:
+            return
+        try:
+            await self._loop.run_in_executor(self._executor, self.console.check_cal)
+        except Exception as e:
+            print("Idle calibration failed: %r" % (e,))
+
+
+class Client:
+    #Connection to a Server. submit() queues a job and returns a Future for its result, so a whole batch can be
+    #queued before waiting on any of it. Results come back with their arrays as numpy arrays.
+
+    def __init__(self, path = None, host = "127.0.0.1", port = 5960):
+        if path is not None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(path)
+        else:
+            self._sock = socket.create_connection((host, port))
+        self._lock = Lock()
+        self._futures = {}
+        self._next = 0
+        self._listener = Thread(target=self._listen, daemon=True)
+        self._listener.start()
+
+    def submit(self, name, priority = 0, **kwargs):
+        future = Future()
+        with self._lock:
+            job_id = self._next
+            self._next += 1
+            self._futures[job_id] = future
+            for piece in pack({"id": job_id, "name": name, "priority": priority}, kwargs):
+                self._sock.sendall(piece)
+        return future
+
+    def call(self, name, priority = 0, **kwargs):
+        return self.submit(name, priority, **kwargs).result()
+
+    def batch(self, jobs, priority = 0):
+        #Run a list of (name, kwargs) jobs and return their results in order
+        futures = [self.submit(name, priority, **kwargs) for name, kwargs in jobs]
+        return [f.result() for f in futures]
+
+    def close(self):
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._listener.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _recv(self, n):
+        buff = bytearray(n)
+        view = memoryview(buff)
+        while view:
+            k = self._sock.recv_into(view)
+            if k == 0:
+                raise EOFError
+            view = view[k:]
+        return buff
+
+    def _listen(self):
+        #Resolve the futures as the results come back
+        while True:
+            try:
+                text_len, payload_len = struct.unpack("!II", self._recv(8))
+                text = self._recv(text_len)
+                response = unpack(bytes(text), self._recv(payload_len))
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                future = self._futures.pop(response.get("id"), None)
+            if future is None:
+                continue
+            if response["ok"]:
+                future.set_result(response["body"])
+            else:
+                future.set_exception(_error(response))
+
+        with self._lock:
+            futures, self._futures = self._futures, {}
+        for future in futures.values():
+            future.set_exception(RuntimeError("connection to the server closed"))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve one SDMRR console to local clients")
+    parser.add_argument("--socket", help="Unix socket path, instead of localhost TCP")
+    parser.add_argument("--port", type=int, default=5960)
+    parser.add_argument("--args", default="type=b200", help="UHD device arguments")
+    parser.add_argument("--cal-path", default="cal.json")
+    parser.add_argument("--idle", type=float, default=10.0, help="seconds without jobs before checking the calibration")
+    options = parser.parse_args()
+    server = Server(path=options.socket, port=options.port, idle=options.idle, args=options.args, cal_path=options.cal_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
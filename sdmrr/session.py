@@ -0,0 +1,53 @@
+class RadioSession:
+    #Owns the TX and RX streamers of a radio and remembers its current rate, tuning and gain, so that repeated
+    #shots only reconfigure what changed. Streamers are created on first use and kept until reset().
+
+    def __init__(self, radio, backend, tx_channel = 0, rx_channel = 1):
+        self.radio = radio
+        self.uhd = backend
+        self.lib = backend.libpyuhd
+        self.tx_channel = tx_channel
+        self.rx_channel = rx_channel
+        self._tx_streamer = None
+        self._rx_streamer = None
+        self._state = {}
+
+    def tx_streamer(self):
+        if self._tx_streamer is None:
+            tx_st_args = self.lib.usrp.stream_args("fc32", "sc16")
+            tx_st_args.channels = [self.tx_channel]
+            self._tx_streamer = self.radio.get_tx_stream(tx_st_args)
+            self._forget("tx_")
+        return self._tx_streamer
+
+    def rx_streamer(self):
+        #Creating a streamer stops RX, so this has to happen before the receive command is issued
+        if self._rx_streamer is None:
+            rx_st_args = self.uhd.usrp.StreamArgs("fc32", "sc16")
+            rx_st_args.channels = [self.rx_channel]
+            self._rx_streamer = self.radio.get_rx_stream(rx_st_args)
+            self._forget("rx_")
+        return self._rx_streamer
+
+    def tune(self, rate, tx_freq, tx_gain, rx_freq, rx_gain):
+        r, lib = self.radio, self.lib
+        self._apply("tx_rate", rate, lambda: r.set_tx_rate(rate, self.tx_channel))
+        self._apply("tx_freq", tx_freq, lambda: r.set_tx_freq(lib.types.tune_request(tx_freq), self.tx_channel))
+        self._apply("tx_gain", tx_gain, lambda: r.set_tx_gain(tx_gain, self.tx_channel))
+        self._apply("rx_rate", rate, lambda: r.set_rx_rate(rate, self.rx_channel))
+        self._apply("rx_freq", rx_freq, lambda: r.set_rx_freq(lib.types.tune_request(rx_freq), self.rx_channel))
+        self._apply("rx_gain", rx_gain, lambda: r.set_rx_gain(rx_gain, self.rx_channel))
+
+    def reset(self):
+        #Drop the streamers and the cached settings, e.g. after a shot that did not finish cleanly
+        self._tx_streamer = None
+        self._rx_streamer = None
+        self._state = {}
+
+    def _apply(self, key, value, setter):
+        if self._state.get(key) != value:
+            setter()
+            self._state[key] = value
+
+    def _forget(self, prefix):
+        self._state = {k: v for k, v in self._state.items() if not k.startswith(prefix)}
@@ -0,0 +1,543 @@
+import numpy as np
+import time
+import bisect
+from threading import RLock
+from types import SimpleNamespace
+from enum import Enum
+
+# Simulated stand-in for the subset of the UHD python API used by SDMRR. Pass an instance of
+# SimulatedUHD as the backend of the SDMRR class to run sequences without a radio attached.
+#
+# The device keeps a clock that runs at `speed` times wall-clock time. Timed TX bursts, GPIO
+# commands and RX stream commands are scheduled against this clock the same way they are on a
+# B2xx, so late commands and overflows happen for the same reasons they happen on hardware.
+# Every contiguous nonzero run of TX samples is applied to an ensemble of isochromats as a hard
+# pulse, and RX samples are synthesized from the ensemble magnetization as they are requested.
+
+class SpinModel:
+
+    def __init__(self, f0 = 22000000.0, t1 = 0.5, t2 = 0.1, t2star = 1e-3, t90 = 50e-6, amplitude = 0.05,
+                 noise = 2e-3, dead_time = 40e-6, leakage = 0.1, lo = 120e6, nspins = 256, seed = None):
+        self.f0 = f0                # Larmor frequency (Hz)
+        self.t1 = t1                # Longitudinal relaxation time (s)
+        self.t2 = t2                # Transverse relaxation time (s)
+        self.t2star = t2star        # FID decay time including field inhomogeneity (s)
+        self.t90 = t90              # 90 degree pulse duration at amplitude 1 and TX gain 70 (s)
+        self.amplitude = amplitude  # RX amplitude of the fully tipped magnetization at RX gain 50
+        self.noise = noise          # RX noise standard deviation per quadrature at RX gain 50
+        self.dead_time = dead_time  # Receiver blanking after the end of each pulse (s)
+        self.leakage = leakage      # Fraction of the TX waveform that leaks into RX during pulses, at TX gain 70 and RX gain 50
+        self.lo = lo                # External mixer LO frequency (Hz)
+        self.nspins = nspins        # Number of isochromats used to represent the sample
+        self.seed = seed
+
+    def offsets(self):
+        #Lorentzian line for the inhomogeneous broadening, sampled at evenly spaced quantiles
+        if self.t2star >= self.t2:
+            return np.zeros(self.nspins)
+        width = (1/self.t2star - 1/self.t2) / (2*np.pi)
+        quantiles = (np.arange(self.nspins) + 0.5) / self.nspins
+        return width * np.tan(np.pi * (quantiles - 0.5))
+
+
+class TimeSpec:
+
+    def __init__(self, secs = 0.0):
+        self._secs = float(secs)
+
+    def get_real_secs(self):
+        return self._secs
+
+    def get_full_secs(self):
+        return int(self._secs // 1)
+
+    def get_frac_secs(self):
+        return self._secs % 1
+
+
+class TuneRequest:
+
+    def __init__(self, target_freq = 0.0, lo_off = 0.0):
+        self.target_freq = target_freq
+        self.lo_off = lo_off
+
+
+class StreamArgs:
+
+    def __init__(self, cpu = "fc32", otw = "sc16"):
+        self.cpu_format = cpu
+        self.otw_format = otw
+        self.channels = [0]
+        self.args = ""
+
+
+class StreamMode(Enum):
+    start_cont = 97
+    stop_cont = 111
+    num_done = 100
+    num_more = 109
+
+
+class StreamCMD:
+
+    def __init__(self, mode):
+        self.stream_mode = mode
+        self.num_samps = 0
+        self.stream_now = True
+        self.time_spec = TimeSpec(0.0)
+
+
+class RXMetadataErrorCode(Enum):
+    none = 0x0
+    timeout = 0x1
+    late = 0x2
+    broken_chain = 0x4
+    overflow = 0x8
+    alignment = 0xC
+    bad_packet = 0xF
+
+
+class TXMetadataEventCode(Enum):
+    burst_ack = 0x1
+    underflow = 0x2
+    seq_error = 0x4
+    time_error = 0x8
+    underflow_in_packet = 0x10
+    seq_error_in_packet = 0x20
+    user_payload = 0x40
+
+
+class RXMetadata:
+
+    def __init__(self):
+        self.error_code = RXMetadataErrorCode.none
+        self.has_time_spec = False
+        self.time_spec = TimeSpec(0.0)
+        self.start_of_burst = False
+        self.end_of_burst = False
+        self.more_fragments = False
+        self.fragment_offset = 0
+        self.out_of_sequence = False
+
+
+class TXMetadata:
+
+    def __init__(self):
+        self.has_time_spec = False
+        self.time_spec = TimeSpec(0.0)
+        self.start_of_burst = False
+        self.end_of_burst = False
+
+
+class TXAsyncMetadata:
+
+    def __init__(self):
+        self.channel = 0
+        self.has_time_spec = False
+        self.time_spec = TimeSpec(0.0)
+        self.event_code = TXMetadataEventCode.burst_ack
+
+
+class SimUSRP:
+
+    BLOCK = 4096        # Samples synthesized per matrix product
+    TX_FIFO = 32768     # Samples the device can hold for bursts that have not been played yet
+    RX_FIFO = 262144    # Samples the device can hold before the host has to recv() them
+
+    def __init__(self, args = "", model = None, speed = 1.0):
+        self.args = args
+        self.model = SpinModel() if model is None else model
+        self.speed = speed
+
+        self.tx_rate = 1e6
+        self.rx_rate = 1e6
+        self.tx_freq = self.model.f0 + self.model.lo
+        self.rx_freq = self.model.f0 + self.model.lo
+        self.tx_gain = 70
+        self.rx_gain = 50
+
+        self.gpio = {}
+        self.gpio_log = []      # (command time or None, bank, attr, value, mask)
+        self.command_time = None
+
+        #Counters, useful for checking what a sequence actually did to the device
+        self.bursts = 0
+        self.late_bursts = 0
+        self.late_commands = 0
+        self.overflows = 0
+        self.underflows = 0
+        self.tx_streams = 0
+        self.rx_streams = 0
+
+        self._lock = RLock()
+        self._time_ref = time.monotonic()
+        self._time_set = 0.0
+        self._rng = np.random.default_rng(self.model.seed)
+        self._offsets = self.model.offsets()
+        self._mxy = np.zeros(self.model.nspins, dtype=np.complex128)
+        self._mz = np.ones(self.model.nspins)
+        self._state_time = 0.0
+        self._events = []       # (time, sequence number, flip angle, phase), kept sorted
+        self._blanks = []       # (start, end) receiver blanking intervals
+        self._leaks = []        # (start, samples) TX pulses seen by the receiver
+        self._nevents = 0
+        self._queued = []       # (start, end) of TX samples still waiting in the FIFO
+        self._phasors = None
+
+    ############################## Clock ##########################
+    def _now(self):
+        return self._time_set + (time.monotonic() - self._time_ref) * self.speed
+
+    def _wait_until(self, t):
+        delay = (t - self._now()) / self.speed
+        if delay > 0:
+            time.sleep(delay)
+
+    def get_time_now(self, mboard = 0):
+        return TimeSpec(self._now())
+
+    def set_time_now(self, time_spec, mboard = 0):
+        with self._lock:
+            #Let the spins relax through the time that passed on the old timebase
+            self._advance(self._now())
+            self._events = []
+            self._blanks = []
+            self._leaks = []
+            self._queued = []
+            self._time_set = time_spec.get_real_secs()
+            self._time_ref = time.monotonic()
+            self._state_time = self._time_set
+
+    def set_command_time(self, time_spec, mboard = 0):
+        self.command_time = time_spec.get_real_secs()
+
+    def clear_command_time(self, mboard = 0):
+        self.command_time = None
+
+    ############################## Settings ##########################
+    def set_tx_rate(self, rate, chan = 0):
+        self.tx_rate = rate
+
+    def set_rx_rate(self, rate, chan = 0):
+        self.rx_rate = rate
+        self._phasors = self._make_phasors() #here rather than in the first recv(), where it holds up the sends
+
+    def get_tx_rate(self, chan = 0):
+        return self.tx_rate
+
+    def get_rx_rate(self, chan = 0):
+        return self.rx_rate
+
+    def set_tx_freq(self, tune_request, chan = 0):
+        self.tx_freq = tune_request.target_freq
+
+    def set_rx_freq(self, tune_request, chan = 0):
+        self.rx_freq = tune_request.target_freq
+
+    def get_tx_freq(self, chan = 0):
+        return self.tx_freq
+
+    def get_rx_freq(self, chan = 0):
+        return self.rx_freq
+
+    def set_tx_gain(self, gain, chan = 0):
+        self.tx_gain = gain
+
+    def set_rx_gain(self, gain, chan = 0):
+        self.rx_gain = gain
+
+    def get_tx_gain(self, chan = 0):
+        return self.tx_gain
+
+    def get_rx_gain(self, chan = 0):
+        return self.rx_gain
+
+    def set_gpio_attr(self, bank, attr, value, mask = 0xFFFFFFFF, mboard = 0):
+        if self.command_time is not None and self.command_time < self._now():
+            self.late_commands += 1
+        self.gpio_log.append((self.command_time, bank, attr, value, mask))
+        old = self.gpio.get((bank, attr), 0)
+        self.gpio[(bank, attr)] = (old & ~mask) | (value & mask)
+
+    def get_gpio_attr(self, bank, attr, mboard = 0):
+        return self.gpio.get((bank, attr), 0)
+
+    def get_tx_stream(self, args):
+        self.tx_streams += 1
+        return SimTXStreamer(self, args)
+
+    def get_rx_stream(self, args):
+        self.rx_streams += 1
+        return SimRXStreamer(self, args)
+
+    ############################## Spin Physics ##########################
+    def _relax(self, tau):
+        if tau <= 0:
+            return
+        m = self.model
+        self._mxy *= np.exp((2j*np.pi*self._offsets - 1/m.t2) * tau)
+        self._mz = 1 - (1 - self._mz) * np.exp(-tau / m.t1)
+
+    def _rotate(self, flip, phase):
+        mx, my, mz = self._mxy.real, self._mxy.imag, self._mz
+        nx, ny = np.cos(phase), np.sin(phase)
+        c, s = np.cos(flip), np.sin(flip)
+        dot = (nx*mx + ny*my) * (1 - c)
+        rx = mx*c + ny*mz*s + nx*dot
+        ry = my*c - nx*mz*s + ny*dot
+        self._mz = mz*c + (nx*my - ny*mx)*s
+        self._mxy = rx + 1j*ry
+
+    def _advance(self, t):
+        while self._events and self._events[0][0] <= t:
+            etime, _, flip, phase = self._events.pop(0)
+            self._relax(etime - self._state_time)
+            self._state_time = max(etime, self._state_time)
+            self._rotate(flip, phase)
+        self._relax(t - self._state_time)
+        self._state_time = max(t, self._state_time)
+
+    def _pulse(self, start, samples):
+        #Apply each contiguous nonzero run of a TX burst as a hard pulse
+        fs = self.tx_rate
+        nonzero = np.flatnonzero(samples)
+        if len(nonzero) == 0:
+            return
+        breaks = np.flatnonzero(np.diff(nonzero) > 1)
+        starts = nonzero[np.concatenate(([0], breaks + 1))]
+        ends = nonzero[np.concatenate((breaks, [len(nonzero) - 1]))] + 1
+
+        offset = self.tx_freq - self.model.lo - self.model.f0
+        rate = (np.pi/2) / self.model.t90 * 10**((self.tx_gain - 70)/20)
+        for i0, i1 in zip(starts, ends):
+            t = start + np.arange(i0, i1)/fs
+            b1 = np.sum(samples[i0:i1] * np.exp(2j*np.pi*offset*t)) / fs * rate
+            tstart, tend = start + i0/fs, start + i1/fs
+            self._nevents += 1
+            bisect.insort(self._events, ((tstart + tend)/2, self._nevents, np.abs(b1), np.angle(b1)))
+            self._blanks.append((tstart, tend + self.model.dead_time))
+            if self.model.leakage:
+                #Leakage reaches the RX baseband at the difference of the TX and RX center frequencies
+                leak = samples[i0:i1] * self.model.leakage * 10**((self.tx_gain - 70)/20) * np.exp(2j*np.pi*(self.tx_freq - self.rx_freq)*t)
+                self._leaks.append((tstart, leak.astype(np.complex64)))
+
+    def _make_phasors(self):
+        #Evolution of each isochromat over the samples of a block
+        tau = np.arange(self.BLOCK)[:, None] / self.rx_rate
+        return np.exp((2j*np.pi*self._offsets[None, :] - 1/self.model.t2) * tau).astype(np.complex64)
+
+    def _synthesize(self, t0, out):
+        fs = self.rx_rate
+        m = self.model
+        n = len(out)
+        if self._phasors is None:
+            self._phasors = self._make_phasors()
+
+        k = 0
+        while k < n:
+            t = t0 + k/fs
+            self._advance(t)
+            step = min(n - k, self.BLOCK)
+            if self._events:
+                step = min(step, max(1, int(np.ceil((self._events[0][0] - t) * fs))))
+            if np.max(np.abs(self._mxy)) < 1e-9:
+                out[k:k+step] = 0
+            else:
+                np.dot(self._phasors[:step], self._mxy.astype(np.complex64), out=out[k:k+step])
+            k += step
+        self._advance(t0 + n/fs)
+
+        #Mix into the RX baseband and apply the RX gain
+        scale = 10**((self.rx_gain - 50)/20) / m.nspins * m.amplitude
+        out *= (scale * np.exp(2j*np.pi*(m.f0 + m.lo - self.rx_freq) * (t0 + np.arange(n)/fs))).astype(np.complex64)
+
+        tend = t0 + n/fs
+        self._blanks = [b for b in self._blanks if b[1] > t0]
+        for bstart, bend in self._blanks:
+            if bstart < tend:
+                out[max(0, int(np.ceil((bstart - t0)*fs))):max(0, int(np.ceil((bend - t0)*fs)))] = 0
+
+        self._leaks = [l for l in self._leaks if l[0] + len(l[1])/fs > t0]
+        for lstart, leak in self._leaks:
+            if lstart < tend:
+                i = int(np.ceil((lstart - t0)*fs))
+                out[max(0, i):i + len(leak)] += leak[max(0, -i):n - i] * np.complex64(10**((self.rx_gain - 50)/20))
+
+        if m.noise > 0:
+            sigma = m.noise * 10**((self.rx_gain - 50)/20)
+            out += (sigma * self._rng.standard_normal(2*n)).astype(np.float32).view(np.complex64)
+
+
+class SimTXStreamer:
+
+    def __init__(self, device, args):
+        self._device = device
+        self.channels = list(args.channels)
+        self._next_time = None
+        self._async = []
+
+    def get_num_channels(self):
+        return len(self.channels)
+
+    def get_max_num_samps(self):
+        return 2040
+
+    def send(self, buff, metadata, timeout = 0.1):
+        dev = self._device
+        samples = np.asarray(buff).reshape(-1)
+        n = len(samples)
+        fs = dev.tx_rate
+
+        with dev._lock:
+            if metadata.has_time_spec:
+                start = metadata.time_spec.get_real_secs()
+            elif self._next_time is not None:
+                start = self._next_time
+                if start < dev._now():
+                    #The rest of the burst arrived after the device ran out of samples, it plays late
+                    dev.underflows += 1
+                    self._async.append((TXMetadataEventCode.underflow, start))
+                    start = dev._now()
+            else:
+                start = dev._now()
+
+            if metadata.has_time_spec and (start < dev._now() or start < dev._state_time):
+                #Late bursts are dropped by the device
+                dev.late_bursts += 1
+                self._async.append((TXMetadataEventCode.time_error, start))
+                self._next_time = None if metadata.end_of_burst else start + n/fs
+                return n
+
+            if metadata.start_of_burst or metadata.has_time_spec:
+                dev.bursts += 1
+            dev._pulse(start, samples)
+            dev._queued.append((start, start + n/fs))
+            self._next_time = None if metadata.end_of_burst else start + n/fs
+            if metadata.end_of_burst:
+                self._async.append((TXMetadataEventCode.burst_ack, start + n/fs))
+
+        #Block until the FIFO has room for the rest of the burst
+        while True:
+            now = dev._now()
+            dev._queued = [q for q in dev._queued if q[1] > now]
+            pending = sum((qend - max(qstart, now)) for qstart, qend in dev._queued) * fs
+            if pending <= SimUSRP.TX_FIFO:
+                return n
+            time.sleep(min(1e-3, (pending - SimUSRP.TX_FIFO) / fs / dev.speed))
+
+    def recv_async_msg(self, metadata, timeout = 0.1):
+        if not self._async:
+            time.sleep(timeout)
+            if not self._async:
+                return False
+        code, t = self._async.pop(0)
+        metadata.event_code = code
+        metadata.has_time_spec = True
+        metadata.time_spec = TimeSpec(t)
+        return True
+
+
+class SimRXStreamer:
+
+    def __init__(self, device, args):
+        self._device = device
+        self.channels = list(args.channels)
+        self._start = None
+        self._total = 0
+        self._done = 0
+
+    def get_num_channels(self):
+        return len(self.channels)
+
+    def get_max_num_samps(self):
+        return 2040
+
+    def issue_stream_cmd(self, stream_cmd):
+        dev = self._device
+        if stream_cmd.stream_mode == StreamMode.stop_cont:
+            self._start = None
+            return
+        now = dev._now()
+        self._start = now if stream_cmd.stream_now else stream_cmd.time_spec.get_real_secs()
+        self._late = self._start < now
+        self._total = np.inf if stream_cmd.stream_mode == StreamMode.start_cont else int(stream_cmd.num_samps)
+        self._done = 0
+
+    def recv(self, buff, metadata, timeout = 0.1):
+        dev = self._device
+        out = buff[0] if np.ndim(buff) > 1 else buff
+        fs = dev.rx_rate
+        deadline = time.monotonic() + timeout
+        metadata.error_code = RXMetadataErrorCode.none
+        metadata.start_of_burst = False
+        metadata.end_of_burst = False
+
+        if self._start is None or self._done >= self._total:
+            time.sleep(timeout)
+            metadata.error_code = RXMetadataErrorCode.timeout
+            return 0
+        if self._late:
+            self._start = None
+            metadata.error_code = RXMetadataErrorCode.late
+            return 0
+
+        #Samples that arrived while nobody was receiving them are lost once the FIFO fills
+        ready = int((dev._now() - self._start) * fs) - self._done
+        if ready > SimUSRP.RX_FIFO:
+            with dev._lock:
+                self._done += ready - SimUSRP.RX_FIFO
+                dev._advance(self._start + self._done/fs)
+            dev.overflows += 1
+            metadata.error_code = RXMetadataErrorCode.overflow
+            metadata.has_time_spec = True
+            metadata.time_spec = TimeSpec(self._start + self._done/fs)
+            return 0
+
+        want = int(min(len(out), self._total - self._done))
+        while True:
+            ready = min(int((dev._now() - self._start) * fs) - self._done, want)
+            if ready >= want or time.monotonic() >= deadline:
+                break
+            dev._wait_until(min(self._start + (self._done + want)/fs,
+                                dev._now() + (deadline - time.monotonic()) * dev.speed))
+        if ready <= 0:
+            metadata.error_code = RXMetadataErrorCode.timeout
+            return 0
+
+        #Synthesize a block at a time, so sends do not wait on the lock for a whole buffer
+        t0 = self._start + self._done/fs
+        for k in range(0, ready, SimUSRP.BLOCK):
+            with dev._lock:
+                dev._synthesize(t0 + k/fs, out[k:min(ready, k + SimUSRP.BLOCK)])
+        metadata.has_time_spec = True
+        metadata.time_spec = TimeSpec(t0)
+        metadata.start_of_burst = self._done == 0
+        self._done += ready
+        metadata.end_of_burst = self._done >= self._total
+        return ready
+
+
+class SimulatedUHD:
+
+    def __init__(self, model = None, speed = 1.0):
+        self.model = SpinModel() if model is None else model
+        self.speed = speed
+        self.devices = []
+
+        def _multi_usrp(args = ""):
+            device = SimUSRP(args, self.model, self.speed)
+            self.devices.append(device)
+            return device
+
+        #Mirror the layout of the uhd package, including the lower case libpyuhd aliases
+        self.usrp = SimpleNamespace(MultiUSRP=_multi_usrp, StreamArgs=StreamArgs, stream_args=StreamArgs)
+        self.types = SimpleNamespace(
+            TimeSpec=TimeSpec, time_spec=TimeSpec,
+            TuneRequest=TuneRequest, tune_request=TuneRequest,
+            StreamCMD=StreamCMD, stream_cmd=StreamCMD, StreamMode=StreamMode, stream_mode=StreamMode,
+            RXMetadata=RXMetadata, rx_metadata=RXMetadata, RXMetadataErrorCode=RXMetadataErrorCode,
+            TXMetadata=TXMetadata, tx_metadata=TXMetadata,
+            TXAsyncMetadata=TXAsyncMetadata, async_metadata=TXAsyncMetadata,
+            TXMetadataEventCode=TXMetadataEventCode,
+        )
+        self.libpyuhd = self
@@ -0,0 +1,62 @@
+import numpy as np
+import time
+
+def frequency_offset(segments, fs, lag = 50):
+    #Estimate the frequency of demodulated data from its phase evolution, using the lag product
+    #sum(x[n+lag]*conj(x[n])) over one segment or each row of a stack of segments (e.g. echo windows).
+    #Offsets are unambiguous up to fs/(2*lag). Returns the offset in Hz and a quality between 0 (noise) and 1 (a pure tone).
+    segments = np.atleast_2d(segments)
+    lag = min(lag, segments.shape[-1] // 2)
+    if lag < 1:
+        return 0.0, 0.0
+    products = segments[:, lag:] * np.conj(segments[:, :-lag])
+    total = np.sum(products)
+    power = np.sum(np.abs(products))
+    if power == 0:
+        return 0.0, 0.0
+    return float(np.angle(total) * fs / (2*np.pi*lag)), float(np.abs(total) / power)
+
+
+class FrequencyTracker:
+    #Follows slow drifts of the Larmor frequency from measurements made during ordinary acquisitions.
+    #Measurements with a low quality, or further than max_step from the current estimate, are rejected. Accepted
+    #ones move the estimate by `gain` of the difference. A full calibration is needed when the estimate has drifted
+    #more than max_drift from the last calibration, or when the last max_rejects measurements were all rejected.
+
+    def __init__(self, gain = 0.5, max_step = 500, min_quality = 0.5, max_drift = 2000, max_rejects = 3, timeout = 5*60):
+        self.gain = gain
+        self.max_step = max_step
+        self.min_quality = min_quality
+        self.max_drift = max_drift
+        self.max_rejects = max_rejects
+        self.timeout = timeout
+        self.reference = None   # f0 of the last full calibration
+        self.drift = 0.0
+        self.rejects = 0
+        self.last_update = None # time.time() of the last accepted measurement
+
+    def reset(self, f0):
+        self.reference = f0
+        self.drift = 0.0
+        self.rejects = 0
+        self.last_update = None
+
+    def update(self, f0, measured, quality):
+        #Return the new estimate of f0, given the current one and a measurement
+        if self.reference is None:
+            self.reference = f0
+        if quality < self.min_quality or abs(measured - f0) > self.max_step:
+            self.rejects += 1
+            return f0
+
+        self.rejects = 0
+        self.last_update = time.time()
+        f0 = f0 + self.gain * (measured - f0)
+        self.drift = f0 - self.reference
+        return f0
+
+    def tracking(self):
+        return self.last_update is not None and time.time() - self.last_update < self.timeout
+
+    def needs_cal(self):
+        return abs(self.drift) > self.max_drift or self.rejects >= self.max_rejects
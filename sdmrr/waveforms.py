@@ -0,0 +1,16 @@
+import numpy as np
+from functools import lru_cache
+
+@lru_cache(maxsize=256)
+def pulse_waveform(duration, amp, phase, fs, tune_shift, zbuff_time):
+    #Rectangular pulse at -tune_shift from the TX center frequency, preceded by zbuff_time of zeros.
+    #phase is in quadrants (0=0 degrees, 1=90 degrees, etc). The result is cached and read-only, ready to hand to send().
+    nzero = int(zbuff_time * fs)
+    t = np.arange(int(round(duration * fs))) / fs #arange(0, duration, 1/fs) can end a sample late from rounding
+    angle = -tune_shift*np.pi*2*t + phase*np.pi/2
+
+    waveform = np.zeros(nzero + len(t), dtype=np.complex64)
+    waveform.real[nzero:] = amp*np.cos(angle)
+    waveform.imag[nzero:] = amp*np.sin(angle)
+    waveform.flags.writeable = False
+    return waveform
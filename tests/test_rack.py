@@ -0,0 +1,32 @@
+import functools
+import numpy as np
+import pytest
+import sdmrr
+
+F0 = 22.0005e6
+T90 = 50e-6
+
+
+def test_consoles_need_their_own_cal_path():
+    with pytest.raises(ValueError):
+        sdmrr.Rack([dict(args="serial=1"), dict(args="serial=2", cal_path="cal2.json")])
+    with pytest.raises(ValueError):
+        sdmrr.Rack([dict(args="serial=1", cal_path="cal.json"), dict(args="serial=2", cal_path="./cal.json")])
+
+
+def test_rack_on_simulated_consoles(tmp_path):
+    backend = functools.partial(sdmrr.SimulatedUHD, sdmrr.SpinModel(f0=F0, t1=0.02, t2=0.02, t90=T90, seed=1))
+    consoles = [dict(cal_path=str(tmp_path / "cal1.json")), dict(cal_path=str(tmp_path / "cal2.json"))]
+    with sdmrr.Rack(consoles, backend=backend, nocal=True) as rack:
+        kw = dict(f0=F0, t90=T90, tr=1e-3, amp90=0.5, amp180=1, cycle=[1, 1, 1, 1], gated=True, integrate=True, width=200)
+        echoes = rack.run("ncpmg", per_console=[dict(npulses=20), dict(npulses=30)], **kw)
+        assert [e.shape for e in echoes] == [(20,), (30,)]
+        assert all(np.abs(e[:3]).mean() > 2 * np.abs(e[-3:]).mean() for e in echoes)
+
+        #A failing job raises in the coordinator, and the consoles carry on
+        with pytest.raises(ValueError):
+            rack.run("ncpmg", stop=True, f0=F0, t90=T90)
+        future = rack.submit(1, "no_such_method")
+        with pytest.raises(AttributeError):
+            future.result()
+        assert [c["t90"] for c in rack.run("caldict")] == [0.0003, 0.0003]
@@ -0,0 +1,81 @@
+import json
+import os
+import numpy as np
+import pytest
+import sdmrr
+
+F0 = 22.0005e6
+T90 = 50e-6
+
+
+@pytest.fixture
+def mrr(tmp_path):
+    model = sdmrr.SpinModel(f0=F0, t1=0.02, t2=0.02, t2star=1e-3, t90=T90, seed=1)
+    console = sdmrr.SDMRR(nocal=True, backend=sdmrr.SimulatedUHD(model), cal_path=str(tmp_path / "cal.json"))
+    console.caldict.update(f0=F0, t90=T90)
+    assert console.ready(timeout=10)
+    return console
+
+
+def test_record_round_trip(mrr, tmp_path):
+    path = str(tmp_path / "rec")
+    mrr.record(path, sample="water")
+    tr = 3e-3
+    mrr.pulseecho(tr=tr, amp90=0.5, amp180=1)
+    raw = np.array(mrr.buffers.get(int((2*tr + T90)*mrr.FS))[0])
+    decimated = mrr.pulseecho(tr=tr, amp90=0.5, amp180=1, rate=100e3)
+    windows = mrr.ncpmg(tr=1e-3, npulses=40, amp90=0.5, amp180=1, cycle=[1, 1, 1, 1], gated=True, width=200)
+    mrr.stop_recording()
+
+    rec = sdmrr.Recording(path)
+    assert rec.meta["sample"] == "water" and rec.meta["FS"] == mrr.FS
+    assert [r["name"] for r in rec.records] == ["pulseecho", "pulseecho", "ncpmg"]
+    assert rec.select("ncpmg") == [2]
+
+    #Full rate samples as received, decimated ones before they were phased, gated echo windows as returned
+    assert rec[0].dtype == np.complex64 and np.array_equal(rec[0], raw)
+    assert rec.records[1]["params"]["rate"] == 100e3
+    assert np.allclose(np.abs(rec[1]), np.abs(decimated))
+    assert rec[2].shape == (40, 200) and np.array_equal(rec[2], windows)
+    assert rec.records[2]["params"]["gated"] and rec.records[2]["caldict"]["t90"] == T90
+
+
+def test_append_to_existing_recording(tmp_path):
+    path = str(tmp_path / "rec")
+    with sdmrr.Recorder(path, sample="oil") as recorder:
+        recorder.save("a", np.arange(10, dtype=np.float32))
+    with sdmrr.Recorder(path, sample="ignored") as recorder:
+        assert len(recorder) == 1
+        recorder.save("b", np.ones((2, 3), dtype=np.complex64), k=1)
+
+    rec = sdmrr.Recording(path)
+    assert rec.meta["sample"] == "oil"
+    assert len(rec) == 2 and rec.records[0]["file"] != rec.records[1]["file"]
+    assert np.array_equal(rec[0], np.arange(10))
+    assert np.array_equal(rec[1], np.ones((2, 3))) and rec.records[1]["params"] == {"k": 1}
+
+
+def test_truncated_index_line(tmp_path):
+    path = str(tmp_path / "rec")
+    with sdmrr.Recorder(path) as recorder:
+        for i in range(3):
+            recorder.save("shot", np.full(4, i, dtype=np.float32))
+    #Interrupted while writing the index entry of the last shot
+    index = os.path.join(path, "index.jsonl")
+    with open(index) as f:
+        lines = f.readlines()
+    with open(index, "w") as f:
+        f.writelines(lines[:2])
+        f.write(lines[2][:len(lines[2]) // 2])
+
+    rec = sdmrr.Recording(path)
+    assert len(rec) == 2 and np.array_equal(rec[1], np.full(4, 1))
+
+    #Appending afterwards starts on a line of its own
+    with sdmrr.Recorder(path) as recorder:
+        assert len(recorder) == 2
+        recorder.save("shot", np.full(4, 3, dtype=np.float32))
+    rec = sdmrr.Recording(path)
+    assert len(rec) == 3 and np.array_equal(rec[2], np.full(4, 3))
+    with open(index) as f:
+        assert all(json.loads(line) for line in f)
@@ -0,0 +1,209 @@
+import json
+import numpy as np
+import pytest
+import sdmrr
+from sdmrr.analysis import fit_nutation
+
+# End to end smoke tests of the sequences on the simulated radio. The sample relaxes quickly, so a short recovery
+# between shots is enough.
+
+F0 = 22.0005e6
+T90 = 50e-6
+
+
+def _console(tmp_path, t1 = 0.02):
+    model = sdmrr.SpinModel(f0=F0, t1=t1, t2=0.02, t2star=1e-3, t90=T90, seed=1)
+    console = sdmrr.SDMRR(nocal=True, backend=sdmrr.SimulatedUHD(model), cal_path=str(tmp_path / "cal.json"))
+    console.caldict.update(f0=F0, t90=T90)
+    console.metrics = sdmrr.Metrics()
+    assert console.ready(timeout=10)
+    return console
+
+
+@pytest.fixture
+def mrr(tmp_path):
+    return _console(tmp_path)
+
+
+def _ok(mrr, n):
+    shots = list(mrr.metrics.shots)[-n:]
+    assert len(shots) == n
+    assert all(shot.ok() for shot in shots), shots
+
+
+def test_onepulse(mrr):
+    fid = mrr.onepulse(gain=70, amp=1)
+    assert fid.shape == (mrr.NS,)
+    start = int((mrr.DEAD_TIME + T90 + 100e-6)*mrr.FS) + 500
+    assert np.max(np.abs(fid[start:start + 3000])) > 10 * np.mean(np.abs(fid[-500:]))
+    _ok(mrr, 1)
+
+
+def test_pulseecho(mrr):
+    tr = 3e-3
+    data = mrr.pulseecho(tr=tr, amp90=0.5, amp180=1)
+    assert data.shape == (int((2*tr + T90)*mrr.FS),)
+    echo = int((tr + T90)*mrr.FS)
+    assert np.max(np.abs(data[echo - 200:echo + 200])) > 5 * np.mean(np.abs(data[-500:]))
+    _ok(mrr, 1)
+
+
+def test_ncpmg(mrr):
+    tr, npulses = 1e-3, 40
+    trace = mrr.ncpmg(tr=tr, npulses=npulses, amp90=0.5, amp180=1, cycle=[1, 1, 1, 1])
+    assert trace.shape == (int(((npulses + 1)*tr + T90)*mrr.FS),)
+
+    windows = mrr.ncpmg(tr=tr, npulses=npulses, amp90=0.5, amp180=1, cycle=[1, 1, 1, 1], gated=True, width=200)
+    assert windows.shape == (npulses, 200)
+    amps = np.abs(windows.mean(axis=1))
+    assert amps[:5].mean() > 3 * amps[-5:].mean()
+
+    sums = mrr.ncpmg(tr=tr, npulses=npulses, amp90=0.5, amp180=1, cycle=[1, 1, 1, 1], gated=True, integrate=True, width=200)
+    assert sums.shape == (npulses,)
+    _ok(mrr, 3)
+
+
+def test_cpmg_phaseloop(mrr):
+    npulses = 40
+    mags = mrr.cpmg_phaseloop(tr=1e-3, npulses=npulses, recovery=0.05)
+    assert mags.shape == (npulses,)
+    assert mags[:5].mean() > 3 * mags[-5:].mean()
+    _ok(mrr, 4)
+
+
+def test_cal(mrr):
+    mrr.caldict.update(f0=F0 - 1500, t90=20e-6)
+    mrr.tracker = None
+    mrr.cal(recovery=0.05)
+    assert abs(mrr.caldict["f0"] - F0) < 200
+    assert abs(mrr.caldict["t90"] - T90) < 10e-6
+    with open(mrr.cal_path) as f:
+        assert json.load(f)["t90"] == mrr.caldict["t90"]
+
+
+@pytest.mark.parametrize("t90", [8e-6, 12e-6, 30e-6, 80e-6])
+def test_find_t90(tmp_path, t90):
+    model = sdmrr.SpinModel(f0=F0, t1=0.02, t2=0.02, t2star=1e-3, t90=t90, seed=2)
+    mrr = sdmrr.SDMRR(nocal=True, backend=sdmrr.SimulatedUHD(model), cal_path=str(tmp_path / "cal.json"))
+    mrr.caldict.update(f0=F0)
+    mrr.tracker = None
+    result = mrr.find_t90(recovery=0.05)
+    assert abs(result["t90"] - t90) < 0.05 * t90, result
+    assert result["t90_err"] < 0.05 * t90
+
+
+def test_fit_nutation_rejects_noise():
+    #Scores without a nutation curve in them must not give a t90
+    rng = np.random.default_rng(0)
+    t = np.array([5, 7, 10, 14, 19, 27, 38, 53]) * 1e-6
+    for i in range(5):
+        assert fit_nutation(t, 0.02 + 0.002 * rng.standard_normal(len(t))) is None
+
+
+def test_look_locker_back_to_back(tmp_path):
+    #Every shot has to start from a recovered sample, or the inversion depth and T1 come out short
+    mrr = _console(tmp_path, t1=0.2)
+    t1s = [mrr.look_locker(alpha=10, spacing=5e-3, npulses=120, recovery=1.0)["t1"] for i in range(2)]
+    assert all(abs(t1 - 0.2) < 0.01 for t1 in t1s), t1s
+    _ok(mrr, 2)
+
+
+def test_ncpmg_stop(mrr):
+    kw = dict(tr=1e-3, npulses=300, amp90=0.5, amp180=1, cycle=[1, 1, 1, 1], gated=True, width=200)
+    mrr.ncpmg(**dict(kw, npulses=10))
+    streamers = (mrr.session.tx_streamer(), mrr.session.rx_streamer())
+
+    seen = []
+    windows = mrr.ncpmg(on_echo=lambda k, echo: seen.append(k), stop=lambda k, echo: k == 20, **kw)
+    assert 20 < len(windows) < 100
+    assert seen == list(range(len(windows)))
+    shot = mrr.metrics.shots[-1]
+    assert shot.cancelled and shot.ok() and shot.rx_samples < shot.rx_expected / 2
+
+    #A stop on purpose keeps the streamers and leaves the radio ready for the next shot
+    assert (mrr.session.tx_streamer(), mrr.session.rx_streamer()) == streamers
+    assert mrr.ncpmg(**dict(kw, npulses=30)).shape == (30, 200)
+    _ok(mrr, 1)
+
+
+def test_echo_stream(mrr):
+    stream = mrr.echo_stream(tr=1e-3, npulses=300, amp90=0.5, amp180=1, cycle=[1, 1, 1, 1], width=200)
+    for k, echo in stream:
+        assert echo.shape == (200,)
+        if k == 10:
+            break
+    stream.close()
+    assert mrr.metrics.shots[-1].cancelled
+    echoes = list(mrr.echo_stream(stop=sdmrr.EchoStop(), tr=1e-3, npulses=300, amp90=0.5, amp180=1, cycle=[1, 1, 1, 1], width=200))
+    assert 10 <= len(echoes) < 300
+
+
+def test_look_locker_after_ncpmg(tmp_path):
+    #A CPMG train saturates the sample, so the next look_locker has to wait for it to recover like after any other shot
+    mrr = _console(tmp_path, t1=0.2)
+    mrr.ncpmg(tr=1e-3, npulses=200, amp90=0.5, amp180=1, cycle=[1, 1, 1, 1], gated=True, width=200)
+    t1 = mrr.look_locker(alpha=10, spacing=5e-3, npulses=120, recovery=1.0)["t1"]
+    assert abs(t1 - 0.2) < 0.01, t1
+
+
+def test_average_snr_window(tmp_path):
+    #The pulse leaking into the receiver is the peak of the trace, the SNR has to come from the FID
+    model = sdmrr.SpinModel(f0=F0, t1=0.02, t2=0.02, t2star=1e-3, t90=T90, amplitude=0.002, seed=2)
+    mrr = sdmrr.SDMRR(nocal=True, backend=sdmrr.SimulatedUHD(model), cal_path=str(tmp_path / "cal.json"))
+    mrr.caldict.update(f0=F0, t90=T90)
+    avg = mrr.average("onepulse", nshots=4, target_snr=5, recovery=0.05)
+    assert avg.n == 4
+    assert avg.snr() > 5
+    start = int((mrr.DEAD_TIME + T90 + 100e-6)*mrr.FS) + 500
+    assert avg.snr(slice(start, start + 3000)) < 5
+
+
+def test_average_t2_tol(mrr):
+    kw = dict(tr=1e-3, npulses=40, amp90=0.5, amp180=1, cycle=[1, 1, 1, 1])
+    for trace in (dict(), dict(gated=True, width=200)):
+        with pytest.raises(ValueError):
+            mrr.average("ncpmg", nshots=3, t2_tol=0.1, recovery=0.05, **trace, **kw)
+    avg = mrr.average("ncpmg", nshots=5, t2_tol=0.5, recovery=0.05, gated=True, integrate=True, width=200, **kw)
+    assert avg.mean.shape == (40,) and avg.n < 5
+
+
+def test_long_train(mrr):
+    #Real time on the simulator: a 1000 echo train at 250 us echo spacing has to stream without underflows
+    for i in range(2):
+        mrr.ncpmg(tr=250e-6, npulses=1000, amp90=0.5, amp180=1, cycle=[1, 1, 1, 1])
+    _ok(mrr, 2)
+
+
+def test_play_paced(mrr):
+    #Sparse sequences return from each send at once, the GPIO commands must still not be queued far ahead
+    ahead = []
+    set_command_time = mrr.radio.set_command_time
+    def _set_command_time(time_spec):
+        ahead.append(time_spec.get_real_secs() - mrr.radio.get_time_now().get_real_secs())
+        set_command_time(time_spec)
+    mrr.radio.set_command_time = _set_command_time
+    mrr.look_locker(alpha=10, spacing=5e-3, npulses=60, recovery=0)
+    assert len(ahead) == 122
+    assert 0 < min(ahead) and max(ahead) < 0.025
+    assert mrr.radio.late_commands == 0
+    _ok(mrr, 1)
+
+
+def test_drift_recalibrates(tmp_path):
+    #The magnet warms up: f0 is followed from the shots until it has drifted too far, then calibrated again
+    mrr = _console(tmp_path)
+    mrr.tracker = sdmrr.FrequencyTracker(max_drift=500)
+    mrr.tracker.reset(F0)
+    cal = mrr.cal
+    calls = []
+    mrr.cal = lambda: calls.append(cal(recovery=0.05))
+    model = mrr.uhd.model
+    for i in range(12):
+        model.f0 += 100
+        mrr.onepulse(gain=70)
+        if calls:
+            break
+    assert len(calls) == 1 and abs(mrr.tracker.drift) < 500
+    assert abs(mrr.caldict["f0"] - model.f0) < 100
+    with open(mrr.cal_path) as f:
+        assert abs(json.load(f)["f0"] - model.f0) < 100
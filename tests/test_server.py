@@ -0,0 +1,53 @@
+import socket
+import struct
+import numpy as np
+import pytest
+import sdmrr
+from sdmrr.server import pack, unpack
+
+
+@pytest.fixture
+def server(tmp_path):
+    model = sdmrr.SpinModel(f0=22e6, t1=0.02, t2=0.02, seed=1)
+    console = sdmrr.SDMRR(nocal=True, backend=sdmrr.SimulatedUHD(model), cal_path=str(tmp_path / "cal.json"))
+    console.caldict.update(f0=22e6, t90=50e-6)
+    server = sdmrr.Server(console, port=0, calibrate=False).start()
+    yield server
+    server.stop()
+
+
+def _exchange(sock, pieces):
+    for piece in pieces:
+        sock.sendall(piece)
+    header = b""
+    while len(header) < 8:
+        header += sock.recv(8 - len(header))
+    text_len, payload_len = struct.unpack("!II", header)
+    data = b""
+    while len(data) < text_len + payload_len:
+        data += sock.recv(text_len + payload_len - len(data))
+    return unpack(data[:text_len], bytearray(data[text_len:]))
+
+
+def test_bad_frames_get_an_error_and_do_not_stop_the_queue(server):
+    with socket.create_connection(("127.0.0.1", server.port)) as sock:
+        reply = _exchange(sock, pack({"name": "onepulse"}, {}))
+        assert reply["ok"] is False and reply["id"] is None
+        text = b"not json"
+        reply = _exchange(sock, [struct.pack("!II", len(text), 0) + text])
+        assert reply["ok"] is False
+        reply = _exchange(sock, pack({"id": 1, "name": "onepulse", "priority": "high"}, {}))
+        assert reply["ok"] is False and reply["id"] == 1
+
+    with sdmrr.Client(port=server.port) as client:
+        assert client.call("onepulse", gain=50).shape == (server.console.NS,)
+
+
+def test_only_sequences_and_analysis_run(server, tmp_path):
+    with sdmrr.Client(port=server.port) as client:
+        for name, kwargs in [("record", dict(path=str(tmp_path / "rec"))), ("stop_recording", {}), ("_shot", dict(sequence="x")),
+                             ("average", dict(sequence="record", nshots=1, path=str(tmp_path / "rec")))]:
+            with pytest.raises(AttributeError):
+                client.call(name, **kwargs)
+        assert not (tmp_path / "rec").exists()
+        assert np.isclose(client.call("caldict")["f0"], 22e6)
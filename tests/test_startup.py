@@ -0,0 +1,48 @@
+import json
+import sys
+from threading import Thread
+import pytest
+import sdmrr
+from sdmrr.SDMRR import HiddenPrints
+
+
+def test_hidden_prints_leave_stdout_alone_off_the_main_thread():
+    seen = []
+
+    def _worker():
+        with HiddenPrints():
+            seen.append(sys.stdout)
+
+    stdout = sys.stdout
+    thread = Thread(target=_worker)
+    thread.start()
+    thread.join()
+    assert seen == [stdout] and sys.stdout is stdout
+
+
+
+class _FailingCal(sdmrr.SDMRR):
+
+    def check_cal(self, debug = False):
+        raise RuntimeError("no sample")
+
+
+def test_failed_startup_cal_leaves_the_console_usable(tmp_path):
+    cal_path = tmp_path / "cal.json"
+    cal_path.write_text(json.dumps({"f0": 22.0005e6, "t90": 50e-6, "lastcal": 0}))
+    mrr = _FailingCal(backend=sdmrr.SimulatedUHD(sdmrr.SpinModel(f0=22.0005e6, seed=1)), cal_path=str(cal_path))
+    assert mrr.ready(timeout=10)
+    assert isinstance(mrr.cal_error, RuntimeError)
+    assert mrr.ready()
+    assert mrr.onepulse().shape == (mrr.NS,)
+
+
+def test_failed_radio_is_fatal(tmp_path):
+    backend = sdmrr.SimulatedUHD()
+    def _fail(args = ""):
+        raise RuntimeError("no device")
+    backend.usrp.MultiUSRP = _fail
+    mrr = sdmrr.SDMRR(nocal=True, backend=backend, cal_path=str(tmp_path / "cal.json"))
+    for i in range(2):
+        with pytest.raises(RuntimeError):
+            mrr.ready(timeout=10)